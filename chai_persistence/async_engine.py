@@ -0,0 +1,152 @@
+# pylint: disable=line-too-long, missing-module-docstring, too-many-arguments
+# pylint: disable=loop-invariant-statement, loop-try-except-usage
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from logging import debug
+from typing import Callable, List, Optional, Set
+
+from sqlalchemy.orm import scoped_session
+
+from chai_persistence.home_tracker import HomeReconciler
+from chai_persistence.lifecycle import Lifecycle
+from chai_persistence.metrics import record_poll
+from chai_persistence.readings import to_readings
+from chai_persistence.relays import RelayPool
+from chai_persistence.scheduler import SlotScheduler
+from chai_persistence.sharding import Shard
+from chai_persistence.utilities import Slot
+from chai_persistence.writer import ReadingWriter
+
+
+class AsyncPollingEngine:
+    """
+    Poll the Netatmo relays of all homes from a single event loop, rather than from one thread per home.
+    The scheduler indicates when each home is due, upon which the blocking calls to the Netatmo API are run in a
+    bounded executor, while the readings are handed to the writer which stores them in the database in the background.
+    """
+    _st_session: scoped_session
+    _relays: RelayPool
+    _writer: ReadingWriter
+    _scheduler: SlotScheduler
+    _api_executor: ThreadPoolExecutor
+    _tasks: Set[asyncio.Task]
+    _shard: Optional[Shard]
+    _reconciler: Optional[HomeReconciler]
+
+    def __init__(self, *, st_session: scoped_session, writer: ReadingWriter, relays: RelayPool,
+                 scheduler: SlotScheduler, api_workers: int = 32, shard: Optional[Shard] = None):
+        self._st_session = st_session
+        self._relays = relays
+        self._writer = writer
+        self._scheduler = scheduler
+        self._api_executor = ThreadPoolExecutor(max_workers=api_workers, thread_name_prefix="netatmo")
+        self._tasks = set()
+        self._shard = shard
+        self._reconciler = None
+
+    def _spawn(self, coroutine, name: Optional[str] = None) -> asyncio.Task:
+        """ Run a coroutine as a task, keeping a reference to the task until it completes. """
+        task = asyncio.create_task(coroutine, name=name)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def run(self, sleep_duration: int, check_interval: int = 10, lifecycle: Optional[Lifecycle] = None,
+                  drain_timeout: Callable[[], float] = lambda: 0.0):
+        """
+        Repeatedly check for changes to the homes in the database, and start or restart the polling of each home.
+        :param sleep_duration: The number of seconds in between checks of all homes.
+        :param check_interval: The number of seconds in between checks of the homes with a new revision.
+        :param lifecycle: The lifecycle of the process, which stops the polling or reloads all homes when asked to.
+        :param drain_timeout: Get the number of seconds that polls in progress get to hand over their readings when
+                              stopping, counted from when the process was asked to stop; polls still running are then
+                              cancelled. This is only called when stopping, so that a reloaded configuration applies.
+        """
+        loop = asyncio.get_running_loop()
+        # the homes are reconciled in a thread, from which the polling of each home is started and stopped in this loop
+        self._reconciler = HomeReconciler(
+            st_session=self._st_session, limiter=self._relays.limiter, shard=self._shard, sleep_duration=sleep_duration,
+            start=partial(self._start_threadsafe, loop), stop=self._stop, wait=partial(self._wait_threadsafe, loop)
+        )
+        try:
+            while lifecycle is None or not lifecycle.stopping:
+                reloaded = lifecycle is not None and await asyncio.to_thread(lifecycle.reloaded)
+                await asyncio.to_thread(self._reconciler.check, reloaded)
+                if lifecycle is None:
+                    await asyncio.sleep(check_interval)
+                else:
+                    await asyncio.to_thread(lifecycle.wait, check_interval)
+        finally:
+            for label in self._reconciler.labels:
+                self._scheduler.remove(label)
+            timeout = drain_timeout()
+            deadline = lifecycle.deadline(timeout) if lifecycle is not None else time.monotonic() + timeout
+            if self._tasks and deadline > time.monotonic():
+                # no new polls are started, while the polls in progress may still hand their readings to the writer
+                await asyncio.wait(set(self._tasks), timeout=deadline - time.monotonic())
+            for task in list(self._tasks):
+                task.cancel()
+            self._api_executor.shutdown(wait=False)
+
+    def _start_threadsafe(self, loop: asyncio.AbstractEventLoop, label: str, home_db_id: int, netatmo_id: int,
+                          refresh_token: str) -> bool:
+        """ Start polling a home from outside of the event loop, once its relay is prepared in the event loop. """
+        loop.call_soon_threadsafe(lambda: self._spawn(self._start(label, home_db_id, netatmo_id, refresh_token)))
+        return True
+
+    def _stop(self, label: str) -> str:
+        """ Stop scheduling the polls of a home, of which the polls in progress are named after the label of the home. """
+        self._scheduler.remove(label)
+        return label
+
+    def _wait_threadsafe(self, loop: asyncio.AbstractEventLoop, labels: List[str], timeout: float):
+        """ Wait from outside of the event loop for the polls in progress of homes that are no longer polled. """
+        asyncio.run_coroutine_threadsafe(self._wait(labels, timeout), loop).result()
+
+    async def _wait(self, labels: List[str], timeout: float):
+        """ Wait for the polls in progress of homes that are no longer polled, for at most a number of seconds. """
+        polls = [task for task in self._tasks if task.get_name() in labels]
+        if polls:
+            await asyncio.wait(polls, timeout=timeout)
+
+    async def _start(self, label: str, home_db_id: int, netatmo_id: int, refresh_token: str):
+        """
+        Prepare the relay of a single home and have the scheduler indicate whenever the home is due.
+        :param label: The label of the home to poll.
+        :param home_db_id: The database id of the home to poll.
+        :param netatmo_id: The database id of the relay installed in the home.
+        :param refresh_token: The refresh token used to access the relay of the home.
+        """
+        debug("starting polling for home with DB id %s", home_db_id)
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self._api_executor, self._relays.client, netatmo_id, refresh_token)
+        except Exception as err:  # pylint: disable=broad-except
+            debug(f"Could not prepare the relay of home with DB id {home_db_id}: {err}\nRetrying at the next check.")
+            self._reconciler.forget(label, home_db_id)
+            return
+        if self._reconciler.polls(label, home_db_id):  # the home may have changed while its relay was being prepared
+            self._scheduler.add(label, partial(loop.call_soon_threadsafe, self._due, label, netatmo_id))
+
+    def _due(self, label: str, netatmo_id: int, slot: Slot):
+        """ Start polling a relay once the scheduler indicates it is due; this is called from within the event loop. """
+        self._spawn(self._poll(label, netatmo_id, slot), name=label)
+
+    async def _poll(self, label: str, netatmo_id: int, slot: Slot):
+        """
+        Poll the relay of a single home and store the readings in the database.
+        :param label: The label of the home to poll.
+        :param netatmo_id: The database id of the relay to poll.
+        :param slot: The slot to which the readings belong.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            readings = await loop.run_in_executor(self._api_executor, self._relays.snapshot, netatmo_id, slot)
+            record_poll(label, readings)
+            self._writer.put(to_readings(netatmo_id, slot, readings))
+        except Exception as err:  # pylint: disable=broad-except
+            record_poll(label, {})
+            debug(f"Encountered an unexpected and unhandled error: {err}\nSaving the task by ignoring the error.")
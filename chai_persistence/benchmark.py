@@ -0,0 +1,239 @@
+# pylint: disable=line-too-long, missing-module-docstring, too-many-arguments, too-many-locals, too-many-instance-attributes
+# pylint: disable=loop-invariant-statement
+
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from functools import partial
+from typing import Dict, List, Optional, Set
+
+from chai_data_sources.exceptions import NetatmoError
+from pendulum import now
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
+
+from chai_persistence.async_engine import AsyncPollingEngine
+from chai_persistence.db_definitions import Base, Home, NetatmoDevice, db_session
+from chai_persistence.home_interface import HomeInterface
+from chai_persistence.home_tracker import HomeTracker
+from chai_persistence.ratelimit import RateLimiter
+from chai_persistence.readings import Reading
+from chai_persistence.relays import RelayPool
+from chai_persistence.scheduler import SlotScheduler
+from chai_persistence.writer import ReadingWriter
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None  # the peak memory use is only reported on Unix
+
+
+class FakeRelay:
+    """
+    Stand in for the client of a Netatmo relay without making any calls to the Netatmo API.
+    Every value takes `latency` seconds (on average) to retrieve, and fails with the given probabilities, either
+    because the API throttles the call or because of any other error.
+    """
+    _latency: float
+    _error_rate: float
+    _throttle_rate: float
+
+    def __init__(self, *, latency: float = 0.2, error_rate: float = 0.0, throttle_rate: float = 0.0, **_):
+        self._latency = latency
+        self._error_rate = error_rate
+        self._throttle_rate = throttle_rate
+
+    def _call(self, value: float) -> float:
+        time.sleep(random.uniform(0.5, 1.5) * self._latency)
+        chance = random.random()
+        if chance < self._throttle_rate:
+            raise NetatmoError("429 Too Many Requests")
+        if chance < self._throttle_rate + self._error_rate:
+            raise NetatmoError("simulated error")
+        return value
+
+    @property
+    def thermostat_temperature(self) -> float:
+        return self._call(round(random.uniform(16, 22), 1))
+
+    @property
+    def t3_temperature(self) -> float:
+        return self._call(round(random.uniform(15, 23), 1))
+
+    @property
+    def valve_percentage(self) -> float:
+        return self._call(float(random.randint(0, 100)))
+
+
+class _RecordingWriter(ReadingWriter):
+    """ Write readings like the regular writer, while recording which readings of each slot are committed and when. """
+    _lock: threading.Lock
+    commits: Dict[int, int]
+    completed: Dict[int, float]
+    written: Dict[int, int]
+    relays: Dict[int, Set[int]]
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self.commits = {}
+        self.completed = {}
+        self.written = {}
+        self.relays = {}
+
+    def _flush(self, batch: List[Reading]):
+        super()._flush(batch)
+        committed = time.time()
+        with self._lock:
+            for slot_start in {reading.start.int_timestamp for reading in batch}:
+                self.commits[slot_start] = self.commits.get(slot_start, 0) + 1
+                self.completed[slot_start] = committed
+            for reading in batch:
+                slot_start = reading.start.int_timestamp
+                self.written[slot_start] = self.written.get(slot_start, 0) + 1
+                self.relays.setdefault(slot_start, set()).add(reading.netatmo_id)
+
+
+@dataclass
+class BenchmarkReport:
+    """ The outcome of a benchmark, covering only the slots that were polled from start to end. """
+    homes: int
+    slots: int
+    interval: int
+    readings: int
+    throughput: float  # readings committed per second
+    median_completion: float  # seconds from the start of a slot until its last reading is committed
+    max_completion: float
+    missed: int  # the number of slots of a home without any reading
+    commits_per_slot: float
+    peak_threads: int
+    peak_rss: float  # in MiB, or 0 when unknown
+
+    def __str__(self):
+        return "\n".join([
+            f"  polled {self.homes} homes for {self.slots} slots of {self.interval} seconds",
+            f"  committed {self.readings} readings ({self.throughput:.1f} readings per second)",
+            f"  slots completed after {self.median_completion:.2f} seconds (median) and {self.max_completion:.2f} seconds (max)",
+            f"  missed {self.missed} of {self.homes * self.slots} home slots",
+            f"  made {self.commits_per_slot:.1f} database commits per slot",
+            f"  peaked at {self.peak_threads} threads and {self.peak_rss:.0f} MiB resident memory",
+        ])
+
+
+def _seed(engine: Engine, homes: int) -> None:
+    """ Create the tables if needed, and add the given number of homes, each with its own relay. """
+    Base.metadata.create_all(engine)
+    session: Session
+    with db_session(scoped_session(sessionmaker(bind=engine))) as session:
+        devices = [NetatmoDevice(refreshToken=f"benchmark-{index}") for index in range(homes)]
+        session.add_all(devices)
+        session.flush()
+        revision = now("Europe/London")
+        session.add_all(Home(label=f"benchmark-{index:05}", revision=revision, netatmoID=device.id)
+                        for index, device in enumerate(devices))
+
+
+def _sample_threads(stop_event: threading.Event, peak: List[int]):
+    """ Keep track of the highest number of threads until stopped. """
+    while not stop_event.wait(0.1):
+        peak[0] = max(peak[0], threading.active_count())
+
+
+def benchmark(*, homes: int, slots: int, interval: int = 10, database: Optional[str] = None,
+              engine: str = "thread", workers: int = 32, batch_size: int = 1000, batch_delay: float = 1.0,
+              api_rate: float = 10.0, api_burst: float = 20.0, poll_window: float = 240, storage: str = "long",
+              compress: bool = False, deadband: float = 0.0, prepared: bool = False,
+              latency: float = 0.2, error_rate: float = 0.0, throttle_rate: float = 0.0) -> BenchmarkReport:
+    """
+    Poll a number of fake relays with either polling engine, and store their readings in a database.
+    :param homes: The number of homes to poll, each with its own fake relay.
+    :param slots: The number of slots to measure, not counting the partial slot in which polling starts.
+    :param interval: The number of seconds per slot, compressed from the usual five minutes.
+    :param database: The URL of the (scratch) database to store the readings in, defaults to a temporary SQLite file.
+    :param engine: The polling engine to use, either "thread" or "asyncio".
+    :param workers: The number of concurrent Netatmo API calls of the asyncio engine.
+    :param batch_size: The maximum number of readings written in one transaction.
+    :param batch_delay: The maximum number of seconds a reading waits in the writer.
+    :param api_rate: The maximum number of calls per second to the (fake) Netatmo API.
+    :param api_burst: The maximum number of calls to the (fake) Netatmo API made in a burst.
+    :param poll_window: The number of seconds over which polls are spread in a five-minute slot, scaled to the interval.
+    :param storage: Either "long" to store a row per reading, or "wide" to store a row per relay and slot.
+    :param compress: Whether to extend the last stored reading while the value does not change.
+    :param deadband: The largest change of a value which is considered unchanged.
+    :param prepared: Whether the writer keeps a connection of its own and inserts through a prepared statement.
+    :param latency: The average number of seconds each call to a fake relay takes.
+    :param error_rate: The fraction of calls to a fake relay that fail.
+    :param throttle_rate: The fraction of calls to a fake relay that are throttled.
+    :return: The measurements of the benchmark.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        db_engine = create_engine(database or f"sqlite:///{os.path.join(directory, 'benchmark.db')}", future=True)
+        _seed(db_engine, homes)
+        st_session = scoped_session(sessionmaker(bind=db_engine))
+
+        writer = _RecordingWriter(st_session=st_session, batch_size=batch_size, batch_delay=batch_delay,
+                                   storage=storage, compress=compress, deadband=deadband, prepared=prepared)
+        writer.start()
+        relays = RelayPool(client_id="benchmark", client_secret="benchmark",
+                           limiter=RateLimiter(max_rate=api_rate, burst=api_burst),
+                           client_factory=partial(FakeRelay, latency=latency, error_rate=error_rate,
+                                                  throttle_rate=throttle_rate))
+        scheduler = SlotScheduler(interval=interval, window=poll_window * interval / 300)
+        scheduler.start()
+
+        stop_sampling = threading.Event()
+        peak_threads = [threading.active_count()]
+        threading.Thread(target=_sample_threads, args=(stop_sampling, peak_threads), daemon=True).start()
+
+        # only the slots which are polled from start to end are measured, and the last one needs time to be committed
+        first = (int(time.time()) // interval + 1) * interval
+        until = first + slots * interval + batch_delay + 1
+        started = time.time()
+
+        if engine == "asyncio":
+            polling_engine = AsyncPollingEngine(st_session=st_session, writer=writer, relays=relays,
+                                                scheduler=scheduler, api_workers=workers)
+            try:
+                asyncio.run(asyncio.wait_for(polling_engine.run(60 * 60, interval), until - time.time()))
+            except asyncio.TimeoutError:
+                pass
+        else:
+            session: Session
+            with db_session(st_session) as session:
+                home_interfaces = [HomeInterface(home_db_id=home.id, netatmo_id=home.netatmoID, writer=writer,
+                                                 relays=relays, netatmo_refresh_token=home.relay.refreshToken,
+                                                 label=home.label, scheduler=scheduler)
+                                   for home in HomeTracker().changes(session, full=True)]
+            time.sleep(max(0.0, until - time.time()))
+            for home_interface in home_interfaces:
+                home_interface.stop()
+
+        scheduler.stop()
+        writer.stop()
+        writer.join()
+        stop_sampling.set()
+        elapsed = time.time() - started
+        db_engine.dispose()
+
+    measured = [first + index * interval for index in range(slots)]
+    completion = [writer.completed[slot] - slot for slot in measured if slot in writer.completed] or [0.0]
+    readings = sum(writer.written.get(slot, 0) for slot in measured)
+    return BenchmarkReport(
+        homes=homes,
+        slots=slots,
+        interval=interval,
+        readings=readings,
+        throughput=sum(writer.written.values()) / elapsed,
+        median_completion=statistics.median(completion),
+        max_completion=max(completion),
+        missed=sum(homes - len(writer.relays.get(slot, ())) for slot in measured),
+        commits_per_slot=statistics.mean(writer.commits.get(slot, 0) for slot in measured),
+        peak_threads=peak_threads[0],
+        peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource is not None else 0.0,
+    )
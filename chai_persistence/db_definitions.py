@@ -2,11 +2,16 @@
 
 from contextlib import contextmanager
 from dataclasses import dataclass
+from typing import List, Optional
 
 from sqlalchemy import Column, String, Integer, Float, DateTime, ForeignKey, TIMESTAMP, Index
-from sqlalchemy import create_engine
-from sqlalchemy.orm import relationship, declarative_base
-from sqlalchemy.orm import scoped_session
+from sqlalchemy import create_engine, and_
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+from sqlalchemy.orm import relationship, declarative_base, aliased
+from sqlalchemy.orm import scoped_session, Session
+
+from chai_persistence.metrics import POOL_WAIT
 
 
 @dataclass
@@ -16,6 +21,20 @@ class Configuration:
     password: str
     database: str = "chai"
     enable_debugging: bool = False
+    pool_size: int = 5  # the number of connections kept open
+    max_overflow: int = 10  # the number of connections opened on top of those when all of them are in use
+    pool_timeout: float = 30.0  # the number of seconds to wait for a connection before giving up
+    pre_ping: bool = False  # whether to test connections when they are taken from the pool
+    recycle: int = -1  # the number of seconds after which connections are replaced, -1 to keep them
+    statement_timeout: float = 0.0  # the number of seconds after which the database cancels a statement, 0 to never
+
+
+class TimedQueuePool(QueuePool):
+    """ A regular connection pool which measures how long each checkout waits for a connection. """
+
+    def _do_get(self):
+        with POOL_WAIT.time():
+            return super()._do_get()
 
 
 def db_engine(config: Configuration):
@@ -25,7 +44,14 @@ def db_engine(config: Configuration):
     :return: A database engine connection.
     """
     target = f"postgresql+pg8000://{config.username}:{config.password}@{config.server}/{config.database}"
-    return create_engine(target, echo=config.enable_debugging, future=True, client_encoding="utf8")
+    connect_args = {}
+    if config.statement_timeout:
+        # set for the whole session of each connection, so that no statement (nor shutdown) waits on the database forever
+        connect_args["startup_params"] = {"options": f"-c statement_timeout={int(config.statement_timeout * 1000)}"}
+    return create_engine(target, echo=config.enable_debugging, future=True, client_encoding="utf8",
+                         poolclass=TimedQueuePool, pool_size=config.pool_size, max_overflow=config.max_overflow,
+                         pool_timeout=config.pool_timeout, pool_pre_ping=config.pre_ping, pool_recycle=config.recycle,
+                         connect_args=connect_args)
 
 
 @contextmanager
@@ -65,6 +91,13 @@ class NetatmoDevice(Base):
     readings = relationship("NetatmoReading", back_populates="relay")
 
 
+class NetatmoToken(Base):
+    __tablename__ = "netatmotoken"
+    netatmo_id = Column("netatmoid", Integer, ForeignKey("netatmodevice.id"), primary_key=True)
+    accessToken = Column("accesstoken", String, nullable=False)
+    expiresAt = Column("expiresat", TIMESTAMP(timezone=True), nullable=False)  # the access token must be refreshed before
+
+
 class Home(Base):
     __tablename__ = "home"
     id = Column(Integer, primary_key=True)
@@ -72,6 +105,7 @@ class Home(Base):
     revision = Column(TIMESTAMP(timezone=True), nullable=False)
     netatmoID = Column("netatmoid", Integer, ForeignKey("netatmodevice.id"), nullable=False)
     relay: NetatmoDevice = relationship("NetatmoDevice")
+    idxLabelRevision = Index("ix_home_label_revision", label, revision)  # the most recent revision of a home
 
 
 class NetatmoReading(Base):
@@ -83,4 +117,64 @@ class NetatmoReading(Base):
     end = Column(DateTime(timezone=True), nullable=False, index=True)
     reading = Column(Float, nullable=False)
     relay: NetatmoDevice = relationship("NetatmoDevice", back_populates="readings")
-    idxOneReading = Index("ix_one_reading", id, room_id, start, unique=True)
+    idxOneReading = Index("ix_one_reading", netatmo_id, room_id, start, unique=True)  # one reading per relay, room, and slot
+
+
+class NetatmoWideReading(Base):
+    __tablename__ = "netatmowidereading"
+    id = Column(Integer, primary_key=True)
+    netatmo_id = Column("netatmoid", Integer, ForeignKey("netatmodevice.id"), nullable=False)
+    start = Column(DateTime(timezone=True), nullable=False)
+    end = Column(DateTime(timezone=True), nullable=False)
+    thermostat_temperature = Column("thermostattemperature", Float)  # room id 1 in `netatmoreading`
+    valve_temperature = Column("valvetemperature", Float)  # room id 2 in `netatmoreading`
+    valve_percentage = Column("valvepercentage", Float)  # room id 3 in `netatmoreading`
+    idxOneWideReading = Index("ix_one_wide_reading", netatmo_id, start, unique=True)  # one row per relay and slot
+
+
+class NetatmoHourlyReading(Base):
+    __tablename__ = "netatmohourlyreading"
+    netatmo_id = Column("netatmoid", Integer, ForeignKey("netatmodevice.id"), primary_key=True)
+    room_id = Column("roomid", Integer, primary_key=True)
+    start = Column(DateTime(timezone=True), primary_key=True)  # the start of the hour
+    count = Column(Integer, nullable=False)  # the number of readings in the hour
+    minimum = Column(Float, nullable=False)
+    mean = Column(Float, nullable=False)
+    maximum = Column(Float, nullable=False)
+
+
+class NetatmoDailyReading(Base):
+    __tablename__ = "netatmodailyreading"
+    netatmo_id = Column("netatmoid", Integer, ForeignKey("netatmodevice.id"), primary_key=True)
+    room_id = Column("roomid", Integer, primary_key=True)
+    start = Column(DateTime(timezone=True), primary_key=True)  # the start of the day in Europe/London
+    count = Column(Integer, nullable=False)  # the number of readings in the day
+    minimum = Column(Float, nullable=False)
+    mean = Column(Float, nullable=False)
+    maximum = Column(Float, nullable=False)
+
+
+class PersistenceWorker(Base):
+    __tablename__ = "persistenceworker"
+    name = Column(String, primary_key=True)  # the host name and process id of the worker, among others
+    heartbeat = Column(TIMESTAMP(timezone=True), nullable=False)  # the worker is considered dead if not renewed
+
+
+def latest_homes(session: Session, labels: Optional[Select] = None) -> List[Home]:
+    """
+    Get all homes, and only the most recent revision of each home.
+    :param session: The database session to use.
+    :param labels: An optional query of the labels of the homes to restrict the result to.
+    :return: The most recent revision of every home.
+    """
+    home_alias = aliased(Home)
+    query = session.query(
+        Home
+    ).outerjoin(
+        home_alias, and_(Home.label == home_alias.label, Home.revision < home_alias.revision)
+    ).filter(
+        home_alias.revision == None  # noqa: E711  # pylint: disable=singleton-comparison
+    )
+    if labels is not None:
+        query = query.filter(Home.label.in_(labels))
+    return query.all()
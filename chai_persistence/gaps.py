@@ -0,0 +1,173 @@
+# pylint: disable=line-too-long, missing-module-docstring, too-many-arguments
+
+import csv
+import io
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import partial
+from logging import debug
+from typing import Dict, List, Iterable
+
+from chai_data_sources import NetatmoClient
+from pendulum import DateTime, instance
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from chai_persistence.ratelimit import RateLimiter
+from chai_persistence.readings import Reading, THERMOSTAT_TEMPERATURE, VALVE_TEMPERATURE, VALVE_PERCENTAGE
+from chai_persistence.utilities import slot_at
+
+# the measurement of the relay which holds the history of each room id
+_MEASURES = {THERMOSTAT_TEMPERATURE: "thermostat_temperature",
+             VALVE_TEMPERATURE: "t3_temperature",
+             VALVE_PERCENTAGE: "valve_percentage"}
+
+# all missing slots are found in a single query: every slot of every relay that is active at that time is generated,
+#  the slots that have a reading are removed through an anti-join, and consecutive missing slots are merged into gaps;
+#  a slot has a reading when the most recent reading that starts before it (which may span several slots) covers it;
+#  the time range is cast explicitly, as untyped parameters would turn `:end - make_interval(...)` into interval arithmetic
+_GAPS_QUERY = text("""
+WITH relay AS (
+    SELECT home.netatmoid,
+           greatest(home.revision, CAST(:start AS timestamptz)) AS active_from,
+           least(coalesce(min(newer.revision), CAST(:end AS timestamptz)), CAST(:end AS timestamptz)) AS active_until
+    FROM home
+    LEFT JOIN home AS newer ON newer.label = home.label AND newer.revision > home.revision
+    GROUP BY home.id, home.netatmoid, home.revision
+), missing AS (
+    SELECT relay.netatmoid, room.roomid, slot.start
+    FROM relay
+    CROSS JOIN (VALUES (1), (2), (3)) AS room (roomid)
+    CROSS JOIN generate_series(CAST(:start AS timestamptz), CAST(:end AS timestamptz) - make_interval(secs => :interval),
+                               make_interval(secs => :interval)) AS slot (start)
+    WHERE slot.start + make_interval(secs => :interval) > relay.active_from AND slot.start < relay.active_until
+      AND NOT EXISTS (SELECT 1 FROM (SELECT reading."end" FROM netatmoreading AS reading
+                                     WHERE reading.netatmoid = relay.netatmoid AND reading.roomid = room.roomid
+                                       AND reading.start <= slot.start
+                                     ORDER BY reading.start DESC LIMIT 1) AS latest
+                      WHERE latest."end" > slot.start)
+)
+SELECT netatmoid, roomid, min(start) AS start, max(start) + make_interval(secs => :interval) AS "end"
+FROM (
+    SELECT DISTINCT netatmoid, roomid, start,
+           start - dense_rank() OVER (PARTITION BY netatmoid, roomid ORDER BY start) * make_interval(secs => :interval) AS island
+    FROM missing
+) AS numbered
+GROUP BY netatmoid, roomid, island
+ORDER BY netatmoid, roomid, start
+""")
+
+
+# the readings of each relay and slot are combined into a wide row, which only fills in the values that are missing
+_WIDE_INSERT = """
+INSERT INTO netatmowidereading AS wide (netatmoid, start, "end", thermostattemperature, valvetemperature, valvepercentage)
+SELECT netatmoid, start, max("end"), max(reading) FILTER (WHERE roomid = 1), max(reading) FILTER (WHERE roomid = 2),
+       max(reading) FILTER (WHERE roomid = 3)
+FROM backfill
+GROUP BY netatmoid, start
+ON CONFLICT (netatmoid, start) DO UPDATE
+SET thermostattemperature = coalesce(wide.thermostattemperature, excluded.thermostattemperature),
+    valvetemperature = coalesce(wide.valvetemperature, excluded.valvetemperature),
+    valvepercentage = coalesce(wide.valvepercentage, excluded.valvepercentage)
+"""
+
+
+@dataclass(frozen=True)
+class Gap:
+    """ A range of consecutive slots for which a relay has no reading for a room. """
+    netatmo_id: int
+    room_id: int
+    start: DateTime
+    end: DateTime
+
+
+def find_gaps(connection: Connection, start: DateTime, end: DateTime, interval: int) -> List[Gap]:
+    """
+    Find all ranges of slots without a reading, for all relays that were installed in a home at the time.
+    :param connection: The database connection to use.
+    :param start: The start of the time range to inspect, which is rounded down to the start of its slot.
+    :param end: The end of the time range to inspect, which is rounded down to the start of its slot.
+    :param interval: The length of each slot in seconds.
+    :return: The gaps in the readings, ordered by relay, room, and time.
+    """
+    start = slot_at(start.timestamp(), interval).start
+    end = slot_at(end.timestamp(), interval).start
+    rows = connection.execute(_GAPS_QUERY, {"start": start, "end": end, "interval": interval})
+    return [Gap(row.netatmoid, row.roomid, instance(row.start), instance(row.end)) for row in rows]
+
+
+def fetch_history(relay: NetatmoClient, limiter: RateLimiter, gap: Gap, interval: int) -> List[Reading]:
+    """
+    Retrieve the readings for a gap from the historical measurements of a relay.
+    :param relay: The client of the Netatmo relay to retrieve the measurements from.
+    :param limiter: The rate limiter through which all calls to the Netatmo API are made.
+    :param gap: The gap to retrieve the readings for.
+    :param interval: The length of each slot in seconds.
+    :return: The readings for the slots in the gap for which the relay holds a measurement.
+    """
+    # any failure only loses the history of this gap, so that a single relay cannot abort the whole backfill
+    try:
+        measurements = limiter.call(partial(
+            relay.get_measure, measure=_MEASURES[gap.room_id], scale=f"{interval // 60}min",
+            date_begin=gap.start.int_timestamp, date_end=gap.end.int_timestamp
+        ))
+        readings = {}
+        for timestamp, value in measurements:
+            slot = slot_at(timestamp, interval)
+            if gap.start <= slot.start < gap.end:
+                readings[slot.start] = Reading(gap.netatmo_id, gap.room_id, slot.start, slot.end, value)
+    except Exception as err:  # pylint: disable=broad-except
+        debug(f"could not retrieve the history of relay {gap.netatmo_id} for room {gap.room_id}: {err}")
+        return []
+    return list(readings.values())
+
+
+def copy_readings(engine: Engine, readings: Iterable[Reading], storage: str = "long") -> int:
+    """
+    Bulk load readings through `COPY`, ignoring any readings that are already stored.
+    :param engine: The database engine to use.
+    :param readings: The readings to store.
+    :param storage: Either "long" to store a row per reading, or "wide" to store a row per relay and slot.
+    :return: The number of rows that were stored or, for wide rows, completed.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for reading in readings:
+        writer.writerow([reading.netatmo_id, reading.room_id, reading.start.isoformat(), reading.end.isoformat(),
+                         reading.reading])
+
+    with engine.begin() as connection:
+        # COPY cannot skip conflicting rows, so the readings are first copied into a staging table
+        connection.execute(text(
+            'CREATE TEMPORARY TABLE backfill (netatmoid integer, roomid integer, start timestamptz, "end" timestamptz, '
+            'reading double precision) ON COMMIT DROP'
+        ))
+        cursor = connection.connection.cursor()
+        cursor.execute('COPY backfill (netatmoid, roomid, start, "end", reading) FROM STDIN WITH (FORMAT csv)',
+                       stream=io.BytesIO(buffer.getvalue().encode("utf-8")))
+        if storage == "wide":
+            return connection.execute(text(_WIDE_INSERT)).rowcount
+        return connection.execute(text(
+            'INSERT INTO netatmoreading (netatmoid, roomid, start, "end", reading) '
+            'SELECT netatmoid, roomid, start, "end", reading FROM backfill '
+            'ON CONFLICT (netatmoid, roomid, start) DO NOTHING'
+        )).rowcount
+
+
+def backfill(engine: Engine, relays: Dict[int, NetatmoClient], limiter: RateLimiter, gaps: List[Gap], interval: int,
+             workers: int = 8, storage: str = "long") -> int:
+    """
+    Fill the gaps from the historical measurements of the relays, retrieving the history of several gaps in parallel.
+    :param engine: The database engine to use.
+    :param relays: The clients of the Netatmo relays indexed by their database id.
+    :param limiter: The rate limiter through which all calls to the Netatmo API are made.
+    :param gaps: The gaps to fill.
+    :param interval: The length of each slot in seconds.
+    :param workers: The number of gaps for which the history is retrieved concurrently.
+    :param storage: Either "long" to store a row per reading, or "wide" to store a row per relay and slot.
+    :return: The number of rows that were stored.
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as executor:
+        histories = executor.map(lambda gap: fetch_history(relays[gap.netatmo_id], limiter, gap, interval),
+                                 [gap for gap in gaps if gap.netatmo_id in relays])
+        return copy_readings(engine, (reading for history in histories for reading in history), storage)
@@ -3,35 +3,42 @@
 
 import threading
 from logging import debug
+from queue import Queue
+from typing import Optional
 
-from chai_data_sources import Minutes, NetatmoClient
-from chai_data_sources.exceptions import NetatmoError
-from pause import until
-from pendulum import now, datetime
-from sqlalchemy.orm import Session, scoped_session
-
-from chai_persistence.db_definitions import NetatmoReading, db_session, Home
+from chai_persistence.metrics import record_poll
+from chai_persistence.readings import to_readings
+from chai_persistence.relays import RelayPool
+from chai_persistence.scheduler import SlotScheduler
+from chai_persistence.utilities import Slot
+from chai_persistence.writer import ReadingWriter
 
 
 class HomePersistenceThread(threading.Thread):
-    """Thread class with a stop() method. The thread itself has to check
-    regularly for the stopped() condition."""
+    """Thread class with a stop() method. The thread polls the relay of its home whenever the scheduler
+    hands it a slot, and stops once it is handed no slot."""
 
     _stop_event: threading.Event
-    _relay: NetatmoClient
+    _relays: RelayPool
     _home_db_id: int
-    _st_session: scoped_session
-    _interval: Minutes
-    _tz: str = "Europe/London"
+    _netatmo_id: int
+    _writer: ReadingWriter
+    _label: str
+    _scheduler: SlotScheduler
+    _slots: "Queue[Optional[Slot]]"
 
     def __init__(self, *,
-                 relay: NetatmoClient, home_db_id: int, st_session: scoped_session, interval: Minutes = Minutes.MIN_5):
+                 relays: RelayPool, home_db_id: int, netatmo_id: int, writer: ReadingWriter,
+                 label: str, scheduler: SlotScheduler):
         super().__init__()
         self._stop_event = threading.Event()
-        self._relay = relay
+        self._relays = relays
         self._home_db_id = home_db_id
-        self._st_session = st_session
-        self._interval = interval
+        self._netatmo_id = netatmo_id
+        self._writer = writer
+        self._label = label
+        self._scheduler = scheduler
+        self._slots = Queue()
 
     @property
     def stopped(self) -> bool:
@@ -41,77 +48,28 @@ class HomePersistenceThread(threading.Thread):
     def run(self):
         """ Start the execution of this thread in a blocking way. Call `start()` instead for a non-blocking thread. """
         debug("starting run for home with DB id %s", self._home_db_id)
-        bootstrapped = False
+        debug("polling at %.1f seconds into every slot", self._scheduler.offset(self._label))
+        self._scheduler.add(self._label, self._slots.put)
 
         while True:
-            if self.stopped:
+            current = self._slots.get()  # wait until the scheduler indicates the home is due
+            if self.stopped or current is None:
                 print(f"  stopped thread for home with ID {self._home_db_id}")
                 break
 
             # thread is still active, we can continue
-            time = now(self._tz)
-            completed = time.minute // self._interval.value  # number of times the slot has been filled this hour
-            base = datetime(time.year, time.month, time.day, time.hour, tz=self._tz)
-            current_start = base.add(minutes=completed * self._interval.value)
-            current_end = base.add(minutes=(completed + 1) * self._interval.value)
-            current_mid = base.add(minutes=(completed + 0.5) * self._interval.value)
             try:
-                if not bootstrapped:
-                    # wait until the middle of an interval, either the current one or the next one
-                    middle = current_mid if time < current_mid else current_mid.add(minutes=self._interval.value)
-                    bootstrapped = True
-
-                    debug("range:  %s – %s", current_start.isoformat(), current_end.isoformat())
-                    debug("waiting until %s before continuing to align the logging", middle.isoformat())
-                    until(middle.int_timestamp)
-                    debug("bootstrap complete")
-                    continue
-
                 debug("performing data polling")
-
-                session: Session
-                with db_session(self._st_session) as session:
-                    home: Home = session.query(Home).filter_by(id=self._home_db_id).one()
-                    debug("got the home instance")
-                    try:
-                        value = self._relay.thermostat_temperature
-                        # noinspection PyTypeChecker
-                        # ignore the warnings; DateTime is a datetime.datetime (compatible) instance
-                        entry = NetatmoReading(room_id=1, relay=home.relay,
-                                               start=current_start, end=current_end, reading=value)
-                        debug("prepared thermostat reading")
-                        session.add(entry)
-                        debug("stored thermostat reading")
-                    except NetatmoError:
-                        pass
-                    try:
-                        value = self._relay.t3_temperature
-                        # noinspection PyTypeChecker
-                        # ignore the warnings; DateTime is a datetime.datetime (compatible) instance
-                        entry = NetatmoReading(room_id=2, relay=home.relay,
-                                               start=current_start, end=current_end, reading=value)
-                        debug("prepared valve reading")
-                        session.add(entry)
-                        debug("stored valve reading")
-                    except NetatmoError:
-                        pass
-                    try:
-                        value = self._relay.valve_percentage
-                        # noinspection PyTypeChecker
-                        # ignore the warnings; DateTime is a datetime.datetime (compatible) instance
-                        entry = NetatmoReading(room_id=3, relay=home.relay,
-                                               start=current_start, end=current_end, reading=value)
-                        debug("prepared valve status reading")
-                        session.add(entry)
-                        debug("stored valve status reading")
-                    except NetatmoError:
-                        pass
-                    debug("storing in DB")
+                readings = self._relays.snapshot(self._netatmo_id, current)
+                record_poll(self._label, readings)
+                debug("queueing readings to store in DB")
+                self._writer.put(to_readings(self._netatmo_id, current, readings))
             except Exception as err:
+                record_poll(self._label, {})
                 debug(f"Encountered an unexpected and unhandled error: {err}\nSaving the thread by ignoring the error.")
-            debug(f"next polling at %s", current_mid.add(minutes=self._interval.value).isoformat())
-            until(current_mid.add(minutes=self._interval.value).int_timestamp)
 
     def stop(self):
         """ Cancel/stop the execution of this thread. """
         self._stop_event.set()
+        self._scheduler.remove(self._label)
+        self._slots.put(None)
@@ -0,0 +1,165 @@
+# pylint: disable=line-too-long, missing-module-docstring, too-many-instance-attributes, too-many-arguments
+# pylint: disable=loop-invariant-statement
+
+import threading
+import time
+from logging import debug
+from typing import Any, Callable, Dict, List, Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session, scoped_session
+
+from chai_persistence.db_definitions import Home, db_session, latest_homes
+from chai_persistence.ratelimit import RateLimiter
+from chai_persistence.sharding import HomeRow, Shard
+
+
+class HomeTracker:
+    """
+    Track the most recent revision of each home, only inspecting the homes which have a new revision.
+    Each revision of a home is a new row, so the highest home id seen so far acts as a high-water mark: any home with a
+    higher id is a new revision, and only the labels of those homes need their most recent revision to be resolved.
+    """
+    _high_water_mark: int
+
+    def __init__(self):
+        self._high_water_mark = 0
+
+    def changes(self, session: Session, full: bool = False) -> List[Home]:
+        """
+        Get the most recent revision of each home which has a new revision since the previous call.
+        :param session: The database session to use.
+        :param full: Whether to get the most recent revision of all homes instead, e.g. to reconcile the polled homes.
+        :return: The most recent revision of each new or changed home, or of all homes when a full check is requested.
+        """
+        latest_id = session.query(func.max(Home.id)).scalar() or 0
+        if full or self._high_water_mark == 0:
+            homes = latest_homes(session)
+        elif latest_id > self._high_water_mark:
+            homes = latest_homes(session, labels=select(Home.label).where(Home.id > self._high_water_mark))
+        else:
+            homes = []
+        self._high_water_mark = max(self._high_water_mark, latest_id)
+        return homes
+
+
+class HomeReconciler:
+    """
+    Keep the homes which are polled in line with the most recent revision of each home, for either polling engine.
+    Only the homes with a new revision are checked frequently, while all homes are checked periodically and whenever
+    the configuration is reloaded. A home is polled again from scratch when its revision changes. In worker mode only
+    the homes owned by this worker are polled, and a home is only handed over once its last poll is done, or once it
+    took as long as the lease of a worker. How the polling of a home is started, stopped, and waited for is left to the
+    engine, through the functions given.
+    """
+    _st_session: scoped_session
+    _limiter: RateLimiter
+    _shard: Optional[Shard]
+    _sleep_duration: int
+    _start: Callable[[str, int, int, str], bool]
+    _stop: Callable[[str], Any]
+    _wait: Callable[[List[Any], float], None]
+    _tracker: HomeTracker
+    _last_full_check: float
+    _lock: threading.Lock
+    _homes: Dict[str, int]  # the database id of the polled revision of each home, indexed by label
+
+    def __init__(self, *, st_session: scoped_session, limiter: RateLimiter, shard: Optional[Shard], sleep_duration: int,
+                 start: Callable[[str, int, int, str], bool], stop: Callable[[str], Any],
+                 wait: Callable[[List[Any], float], None]):
+        """
+        :param st_session: The database session from which the homes are read.
+        :param limiter: The rate limiter of the Netatmo API, of which the usage is reported at each full check.
+        :param shard: The shard of this worker, or None if this process polls all homes.
+        :param sleep_duration: The number of seconds in between checks of all homes.
+        :param start: Start polling a home given its label, database id, relay id, and relay refresh token, returning
+                      whether the polling started.
+        :param stop: Stop polling a home given its label, returning whatever `wait` needs to wait for its last poll.
+        :param wait: Wait for the last polls of stopped homes, given what `stop` returned, for at most a number of seconds.
+        """
+        self._st_session = st_session
+        self._limiter = limiter
+        self._shard = shard
+        self._sleep_duration = sleep_duration
+        self._start = start
+        self._stop = stop
+        self._wait = wait
+        self._tracker = HomeTracker()
+        self._last_full_check = float("-inf")
+        self._lock = threading.Lock()
+        self._homes = {}
+
+    @property
+    def labels(self) -> List[str]:
+        """ Get the labels of the homes which are being polled. """
+        with self._lock:
+            return list(self._homes)
+
+    def polls(self, label: str, home_db_id: int) -> bool:
+        """ Get whether a home is still to be polled in the given revision, e.g. while its relay is being prepared. """
+        with self._lock:
+            return self._homes.get(label) == home_db_id
+
+    def forget(self, label: str, home_db_id: int):
+        """ Forget a home whose polling could not be started after all, so that it is started again at the next check. """
+        with self._lock:
+            if self._homes.get(label) == home_db_id:
+                del self._homes[label]
+
+    def _changed_homes(self, full: bool) -> List[HomeRow]:
+        """ Get the label, database id, relay id, and relay refresh token of the most recent revision of each changed home. """
+        session: Session
+        with db_session(self._st_session) as session:
+            return [(home.label, home.id, home.netatmoID, home.relay.refreshToken)
+                    for home in self._tracker.changes(session, full=full)]
+
+    def check(self, reloaded: bool = False):
+        """
+        Check the homes for changes once, and start, restart, or stop polling each home which changed.
+        :param reloaded: Whether the configuration was just reloaded, in which case all homes are checked.
+        """
+        full = reloaded or time.monotonic() - self._last_full_check >= self._sleep_duration
+        if full:
+            print("  checking homes for any changes")
+            print(f"  Netatmo API usage is {self._limiter.usage:.2f} calls per second ({self._limiter.headroom:.0%} headroom)")
+            self._last_full_check = time.monotonic()
+
+        try:
+            homes = self._changed_homes(full)
+        except Exception as err:  # pylint: disable=broad-except
+            # the homes that are being polled keep being polled, and all homes are checked again next time
+            debug(f"Encountered an error checking the homes for changes: {err}\nRetrying at the next check.")
+            homes, self._last_full_check = [], float("-inf")
+
+        if self._shard is not None:
+            # only the homes owned by this worker are polled, which changes as other workers join or leave
+            homes, released = self._shard.assign(homes)
+            stopped = []
+            for label in released:
+                print(f"   -stopping polling of the home with the label '{label}'")
+                with self._lock:
+                    polled = self._homes.pop(label, None) is not None
+                if polled:
+                    stopped.append(self._stop(label))
+            if stopped:
+                self._wait(stopped, self._shard.lease)
+            self._shard.release(released)
+
+        for label, home_db_id, netatmo_id, refresh_token in homes:
+            with self._lock:
+                # the polling of a home which has a new revision is stopped, and started again for the new revision
+                changed = label in self._homes and self._homes[label] != home_db_id
+                if changed:
+                    del self._homes[label]
+                started = label in self._homes
+                if not started:
+                    self._homes[label] = home_db_id
+            if changed:
+                self._stop(label)
+            if not started:
+                print(f"   -starting polling of the home with the label '{label}'")
+                if not self._start(label, home_db_id, netatmo_id, refresh_token):
+                    self.forget(label, home_db_id)
+        if homes:
+            print("  started/refreshed the polling of all changed homes")
+            print()
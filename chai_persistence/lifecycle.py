@@ -0,0 +1,95 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import signal
+import threading
+import time
+from typing import Callable, Optional
+
+
+class Lifecycle:
+    """
+    Let the process be asked to stop or to reload its configuration, typically through signals, while every wait in
+    the process can be cut short by either request. SIGTERM and SIGINT ask the process to stop gracefully, and SIGHUP
+    asks it to reload its configuration and the homes without a restart.
+    """
+    _condition: threading.Condition
+    _stopping: bool
+    _reloading: bool
+    _stopped_at: Optional[float]
+    _on_reload: Optional[Callable[[], None]]
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._reloading = False
+        self._stopped_at = None
+        self._on_reload = None
+
+    @property
+    def stopping(self) -> bool:
+        """ Get whether the process has been asked to stop. """
+        return self._stopping
+
+    def install(self):
+        """ Handle the signals to stop and reload; this can only be called from the main thread. """
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        signal.signal(signal.SIGINT, lambda *_: self.stop())
+        if hasattr(signal, "SIGHUP"):  # not available on Windows
+            signal.signal(signal.SIGHUP, lambda *_: self.reload())
+
+    def on_reload(self, callback: Callable[[], None]):
+        """
+        Set what is done when a reload is applied, besides checking all homes again.
+        :param callback: The function that reloads the configuration.
+        """
+        self._on_reload = callback
+
+    def stop(self):
+        """ Ask the process to stop, waking up all waits. """
+        with self._condition:
+            if not self._stopping:
+                self._stopped_at = time.monotonic()
+            self._stopping = True
+            self._condition.notify_all()
+
+    def deadline(self, timeout: float) -> float:
+        """
+        Get the moment by which stopping should be done, so that all steps of a shutdown share the same time budget.
+        :param timeout: The number of seconds a shutdown may take, counted from when the process was asked to stop.
+        :return: The deadline in terms of `time.monotonic()`.
+        """
+        return (self._stopped_at if self._stopped_at is not None else time.monotonic()) + timeout
+
+    def reload(self):
+        """ Ask the process to reload its configuration and the homes, waking up the main loop. """
+        with self._condition:
+            self._reloading = True
+            self._condition.notify_all()
+
+    def wait(self, timeout: float):
+        """
+        Wait until the process is asked to stop or to reload, or until the timeout passes, as the main loop does.
+        :param timeout: The maximum number of seconds to wait.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._stopping or self._reloading, timeout)
+
+    def sleep(self, timeout: float) -> bool:
+        """
+        Wait until the process is asked to stop, or until the timeout passes, as background threads do.
+        :param timeout: The maximum number of seconds to wait.
+        :return: True if the process is stopping, False otherwise.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._stopping, timeout)
+
+    def reloaded(self) -> bool:
+        """
+        Apply a requested reload, if any, which is only done by the main loop.
+        :return: True if a reload was requested, in which case all homes should be checked again.
+        """
+        with self._condition:
+            requested, self._reloading = self._reloading, False
+        if requested and self._on_reload is not None:
+            self._on_reload()
+        return requested
@@ -1,20 +1,35 @@
 # pylint: disable=line-too-long, missing-module-docstring
-# pylint: disable=loop-invariant-statement, loop-global-usage, singleton-comparison
+# pylint: disable=loop-invariant-statement, loop-global-usage
 
+import asyncio
 import logging
 import os
 import sys
+import time
 from threading import Thread
-from typing import Dict
+from functools import partial
+from typing import Callable, Dict, List, Optional
 
 import click
 import tomli
-from pause import sleep
-from sqlalchemy import and_
-from sqlalchemy.orm import aliased, Session, sessionmaker, scoped_session
-
-from chai_persistence.db_definitions import db_session, db_engine, Home, Configuration as DBConfiguration
+from chai_data_sources import Minutes
+from pendulum import now, parse
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
+
+from chai_persistence import benchmark, gaps, metrics, migrations, partitions, rollups
+from chai_persistence.async_engine import AsyncPollingEngine
+from chai_persistence.db_definitions import db_session, db_engine, NetatmoDevice, Configuration as DBConfiguration
 from chai_persistence.home_interface import HomeInterface
+from chai_persistence.home_tracker import HomeReconciler
+from chai_persistence.lifecycle import Lifecycle
+from chai_persistence.ratelimit import RateLimiter
+from chai_persistence.relays import RelayPool
+from chai_persistence.scheduler import SlotScheduler
+from chai_persistence.sharding import Shard
+from chai_persistence.spool import Spool
+from chai_persistence.tokens import TokenCache
+from chai_persistence.writer import ReadingWriter
 
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger("urllib3").setLevel(logging.WARNING)
@@ -37,15 +52,50 @@ class Configuration:  # pylint: disable=too-few-public-methods, too-many-instanc
     db_username: str = ""
     db_password: str = ""
     debug: bool = False
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30.0
+    db_pre_ping: bool = False
+    db_recycle: int = -1
+    db_statement_timeout: float = 0.0
+    engine: str = "thread"
+    workers: int = 32
+    batch_size: int = 1000
+    batch_delay: float = 1.0
+    on_conflict: str = "nothing"
+    check_interval: int = 10
+    poll_window: float = 240
+    api_rate: float = 10.0
+    api_burst: float = 20.0
+    spool: str = ""
+    metrics_port: int = 0
+    storage: str = "long"
+    rollups: bool = False
+    compress: bool = False
+    deadband: float = 0.0
+    retention_months: int = 0
+    shard: bool = False
+    lease: float = 30.0
+    drain_timeout: float = 30.0
+    prepared_inserts: bool = False
 
     def __str__(self):
         return (f"Configuration(client_id={self.client_id}, client_secret={self.client_secret}, "
                 f"db_server={self.db_server}, db_name={self.db_name}, "
                 f"db_username={self.db_username}, db_password={self.db_password}, "
-                f"db_debug={self.debug})")
-
-
-@click.command()
+                f"db_debug={self.debug}, db_pool_size={self.db_pool_size}, db_max_overflow={self.db_max_overflow}, "
+                f"db_pool_timeout={self.db_pool_timeout}, db_pre_ping={self.db_pre_ping}, db_recycle={self.db_recycle}, "
+                f"db_statement_timeout={self.db_statement_timeout}, engine={self.engine}, workers={self.workers}, "
+                f"batch_size={self.batch_size}, batch_delay={self.batch_delay}, on_conflict={self.on_conflict}, "
+                f"check_interval={self.check_interval}, poll_window={self.poll_window}, "
+                f"api_rate={self.api_rate}, api_burst={self.api_burst}, spool={self.spool}, "
+                f"metrics_port={self.metrics_port}, storage={self.storage}, rollups={self.rollups}, "
+                f"compress={self.compress}, deadband={self.deadband}, retention_months={self.retention_months}, "
+                f"shard={self.shard}, lease={self.lease}, drain_timeout={self.drain_timeout}, "
+                f"prepared_inserts={self.prepared_inserts})")
+
+
+@click.group(invoke_without_command=True)
 @click.option("--config", default=None, help="The TOML configuration file.")
 @click.option("--client_id", default=None, help="The client ID for accessing the Netatmo API.")
 @click.option("--client_secret", default=None, help="The file containing the (single line) secret of the client ID.")
@@ -54,7 +104,53 @@ class Configuration:  # pylint: disable=too-few-public-methods, too-many-instanc
 @click.option("--username", default=None, help="The username to access the database.")
 @click.option("--dbpass_file", default=None, help="The file containing the (single line) password for database access.")
 @click.option('--debug', is_flag=True, help="Provides debug output for the database when present.")
-def cli(config, client_id, client_secret, dbserver, db, username, dbpass_file, debug):  # pylint: disable=invalid-name
+@click.option("--pool_size", default=None, type=int, help="The number of database connections kept open, defaults to 5.")
+@click.option("--max_overflow", default=None, type=int, help="The number of database connections opened when all others are in use, defaults to 10.")
+@click.option("--pool_timeout", default=None, type=float, help="The number of seconds to wait for a database connection, defaults to 30.")
+@click.option("--pre_ping", is_flag=True, default=None, help="Test database connections when they are taken from the pool.")
+@click.option("--recycle", default=None, type=int, help="The number of seconds after which database connections are replaced, defaults to never.")
+@click.option("--statement_timeout", default=None, type=float, help="The number of seconds after which the database cancels a statement, defaults to never.")
+@click.option("--engine", default=None, type=click.Choice(["thread", "asyncio"]),
+              help="The polling engine to use, either one thread per home or a single event loop; defaults to thread.")
+@click.option("--workers", default=None, type=int, help="The number of concurrent Netatmo API calls of the asyncio engine.")
+@click.option("--batch_size", default=None, type=int, help="The maximum number of readings written in one transaction, defaults to 1000.")
+@click.option("--batch_delay", default=None, type=float, help="The maximum number of seconds readings wait before being written, defaults to 1.")
+@click.option("--on_conflict", default=None, type=click.Choice(["nothing", "update"]),
+              help="Whether readings that are already stored are ignored or overwritten, defaults to nothing.")
+@click.option("--check_interval", default=None, type=int, help="The number of seconds in between checks for changed homes, defaults to 10.")
+@click.option("--poll_window", default=None, type=float, help="The number of seconds around the middle of a slot over which polls are spread, defaults to 240.")
+@click.option("--api_rate", default=None, type=float, help="The maximum number of calls per second to the Netatmo API, defaults to 10.")
+@click.option("--api_burst", default=None, type=float, help="The maximum number of calls to the Netatmo API made in a burst, defaults to 20.")
+@click.option("--spool", default=None, help="The directory in which readings are kept while the database is unavailable.")
+@click.option("--metrics_port", default=None, type=int, help="The local port on which metrics are served, disabled by default.")
+@click.option("--storage", default=None, type=click.Choice(["long", "wide"]),
+              help="Whether readings are stored as a row per reading or as a row per relay and slot, defaults to long.")
+@click.option("--rollups", is_flag=True, default=None, help="Maintain the hourly and daily rollups of the readings.")
+@click.option("--compress", is_flag=True, default=None, help="Extend the last stored reading while the value does not change.")
+@click.option("--deadband", default=None, type=float, help="The largest change of a value which is considered unchanged, defaults to 0.")
+@click.option("--retention_months", default=None, type=int, help="The number of months of readings to keep in a partitioned table, defaults to all.")
+@click.option("--shard", is_flag=True, default=None, help="Divide the homes between all workers that share the database.")
+@click.option("--lease", default=None, type=float, help="The number of seconds after which a silent worker is considered dead, defaults to 30.")
+@click.option("--drain_timeout", default=None, type=float, help="The number of seconds to spend writing the remaining readings when stopping, defaults to 30.")
+@click.option("--prepared_inserts", is_flag=True, default=None, help="Write readings over a connection of their own through a prepared statement.")
+@click.pass_context
+def cli(ctx, **options):
+    """ Continuously poll the Netatmo relays of all homes, unless a command is given. """
+    settings = _configure(**options)
+
+    if ctx.invoked_subcommand is None:
+        # the same options are applied again whenever the configuration file is reloaded
+        main(settings, partial(_configure, **options))
+    else:
+        ctx.obj = settings
+
+
+def _configure(config, client_id, client_secret, dbserver, db, username, dbpass_file, debug,  # pylint: disable=invalid-name, too-many-arguments
+               pool_size, max_overflow, pool_timeout, pre_ping, recycle, statement_timeout,
+               engine, workers, batch_size, batch_delay, on_conflict, check_interval, poll_window, api_rate, api_burst,
+               spool, metrics_port, storage, rollups, compress, deadband, retention_months,
+               shard, lease, drain_timeout, prepared_inserts) -> Configuration:
+    """ Combine the configuration file with the options given on the command line, which take precedence. """
     settings = Configuration()
 
     if config and not os.path.isfile(config):
@@ -76,6 +172,34 @@ def cli(config, client_id, client_secret, dbserver, db, username, dbpass_file, d
                     settings.db_username = str(toml_db.get("user", settings.db_username))
                     settings.db_password = str(toml_db.get("pass", settings.db_password))
                     settings.debug = bool(toml_db.get("debug", settings.debug))
+                    settings.db_pool_size = int(toml_db.get("pool_size", settings.db_pool_size))
+                    settings.db_max_overflow = int(toml_db.get("max_overflow", settings.db_max_overflow))
+                    settings.db_pool_timeout = float(toml_db.get("pool_timeout", settings.db_pool_timeout))
+                    settings.db_pre_ping = bool(toml_db.get("pre_ping", settings.db_pre_ping))
+                    settings.db_recycle = int(toml_db.get("recycle", settings.db_recycle))
+                    settings.db_statement_timeout = float(toml_db.get("statement_timeout", settings.db_statement_timeout))
+
+                if toml_persistence := toml.get("persistence"):
+                    settings.engine = str(toml_persistence.get("engine", settings.engine))
+                    settings.workers = int(toml_persistence.get("workers", settings.workers))
+                    settings.batch_size = int(toml_persistence.get("batch_size", settings.batch_size))
+                    settings.batch_delay = float(toml_persistence.get("batch_delay", settings.batch_delay))
+                    settings.on_conflict = str(toml_persistence.get("on_conflict", settings.on_conflict))
+                    settings.check_interval = int(toml_persistence.get("check_interval", settings.check_interval))
+                    settings.poll_window = float(toml_persistence.get("poll_window", settings.poll_window))
+                    settings.api_rate = float(toml_persistence.get("api_rate", settings.api_rate))
+                    settings.api_burst = float(toml_persistence.get("api_burst", settings.api_burst))
+                    settings.spool = str(toml_persistence.get("spool", settings.spool))
+                    settings.metrics_port = int(toml_persistence.get("metrics_port", settings.metrics_port))
+                    settings.storage = str(toml_persistence.get("storage", settings.storage))
+                    settings.rollups = bool(toml_persistence.get("rollups", settings.rollups))
+                    settings.compress = bool(toml_persistence.get("compress", settings.compress))
+                    settings.deadband = float(toml_persistence.get("deadband", settings.deadband))
+                    settings.retention_months = int(toml_persistence.get("retention_months", settings.retention_months))
+                    settings.shard = bool(toml_persistence.get("shard", settings.shard))
+                    settings.lease = float(toml_persistence.get("lease", settings.lease))
+                    settings.drain_timeout = float(toml_persistence.get("drain_timeout", settings.drain_timeout))
+                    settings.prepared_inserts = bool(toml_persistence.get("prepared_inserts", settings.prepared_inserts))
             except tomli.TOMLDecodeError:
                 click.echo("The configuration file is not valid and cannot be parsed.")
                 sys.exit(0)
@@ -121,58 +245,376 @@ def cli(config, client_id, client_secret, dbserver, db, username, dbpass_file, d
     if debug is True:
         settings.debug = True
 
-    main(settings)
+    if pool_size is not None:
+        settings.db_pool_size = pool_size
+
+    if max_overflow is not None:
+        settings.db_max_overflow = max_overflow
+
+    if pool_timeout is not None:
+        settings.db_pool_timeout = pool_timeout
+
+    if pre_ping is True:
+        settings.db_pre_ping = True
+
+    if recycle is not None:
+        settings.db_recycle = recycle
+
+    if statement_timeout is not None:
+        settings.db_statement_timeout = statement_timeout
+
+    # [overridden/supplemental persistence settings]
+    if engine is not None:
+        settings.engine = engine
+
+    if workers is not None:
+        settings.workers = workers
+
+    if batch_size is not None:
+        settings.batch_size = batch_size
+
+    if batch_delay is not None:
+        settings.batch_delay = batch_delay
+
+    if on_conflict is not None:
+        settings.on_conflict = on_conflict
+
+    if check_interval is not None:
+        settings.check_interval = check_interval
+
+    if poll_window is not None:
+        settings.poll_window = poll_window
+
+    if api_rate is not None:
+        settings.api_rate = api_rate
+
+    if api_burst is not None:
+        settings.api_burst = api_burst
+
+    if spool is not None:
+        settings.spool = spool
+
+    if metrics_port is not None:
+        settings.metrics_port = metrics_port
+
+    if storage is not None:
+        settings.storage = storage
+
+    if rollups is True:
+        settings.rollups = True
+
+    if compress is True:
+        settings.compress = True
+
+    if deadband is not None:
+        settings.deadband = deadband
 
+    if retention_months is not None:
+        settings.retention_months = retention_months
+
+    if shard is True:
+        settings.shard = True
+
+    if lease is not None:
+        settings.lease = lease
+
+    if drain_timeout is not None:
+        settings.drain_timeout = drain_timeout
+
+    if prepared_inserts is True:
+        settings.prepared_inserts = True
+
+    return settings
+
+
+@cli.command()
+@click.pass_obj
+def migrate(settings: Configuration):
+    """ Apply all database migrations, such as the uniqueness of readings. """
+    print("migrating the database")
+    migrations.migrate(_engine(settings))
+
+
+@cli.command()
+@click.option("--start", required=True, help="The start of the time range to inspect, e.g. 2022-11-01.")
+@click.option("--end", default=None, help="The end of the time range to inspect, defaults to now.")
+@click.option("--dry_run", is_flag=True, help="Only report the gaps without retrieving any historical data.")
+@click.pass_obj
+def backfill(settings: Configuration, start, end, dry_run):
+    """ Find the slots without readings and fill them from the history of the Netatmo relays. """
+    engine = _engine(settings)
+    interval = Minutes.MIN_5.value * 60
+    start = parse(start, tz="Europe/London")
+    end = parse(end, tz="Europe/London") if end else now("Europe/London")
+
+    with engine.connect() as connection:
+        found = gaps.find_gaps(connection, start, end, interval)
+    print(f"  found {len(found)} gaps spanning {sum(gap.end.diff(gap.start).in_seconds() // interval for gap in found)} slots")
+    if dry_run or not found:
+        return
+
+    st_session = scoped_session(sessionmaker(bind=engine))
+    session: Session
+    with db_session(st_session) as session:
+        tokens = {device.id: device.refreshToken for device in
+                  session.query(NetatmoDevice).filter(NetatmoDevice.id.in_({gap.netatmo_id for gap in found}))}
+    # the access tokens are reused and stored like when polling, so that rotated refresh tokens are never lost
+    relays = _relays(settings, TokenCache(st_session))
+    clients = {netatmo_id: relays.client(netatmo_id, refresh_token) for netatmo_id, refresh_token in tokens.items()}
+    stored = gaps.backfill(engine, clients, relays.limiter, found, interval, workers=settings.workers,
+                           storage=settings.storage)
+    print(f"  stored {stored} readings")
+    if settings.rollups and stored:
+        with engine.begin() as connection:
+            rollups.rebuild_rollups(connection, start, end)
+
+
+@cli.command()
+@click.pass_obj
+def partition(settings: Configuration):
+    """ Partition the readings by month, creating the partitions of the coming months. """
+    print("partitioning the readings")
+    engine = _engine(settings)
+    with engine.begin() as connection:
+        partitions.partition_readings(connection)
+    partitions.maintain(engine, settings.retention_months)
+
+
+@cli.command()
+@click.pass_obj
+def widen(settings: Configuration):
+    """ Store the readings as a row per relay and slot, presenting them in the original format through a view. """
+    print("storing the readings as wide rows")
+    with _engine(settings).begin() as connection:
+        migrations.widen_readings(connection)
+    print("  set storage = \"wide\" before polling again")
+
+
+@cli.command()
+@click.pass_obj
+def replay(settings: Configuration):
+    """ Store the readings kept in the spool while the database was unavailable. """
+    if not settings.spool:
+        click.echo("No spool directory is configured.")
+        sys.exit(0)
+
+    writer = _writer(settings, scoped_session(sessionmaker(bind=_engine(settings))))
+    print(f"  replayed {writer.replay()} spooled readings")
+
+
+@cli.command()
+@click.option("--homes", default=100, type=int, help="The number of homes to poll, defaults to 100.")
+@click.option("--slots", default=3, type=int, help="The number of slots to measure, defaults to 3.")
+@click.option("--interval", default=10, type=int, help="The number of seconds per slot, defaults to 10.")
+@click.option("--database", default=None, help="The URL of a scratch database to use, defaults to a temporary SQLite file.")
+@click.option("--latency", default=0.2, type=float, help="The average number of seconds per call to a fake relay, defaults to 0.2.")
+@click.option("--error_rate", default=0.0, type=float, help="The fraction of calls to a fake relay that fail, defaults to 0.")
+@click.option("--throttle_rate", default=0.0, type=float, help="The fraction of calls to a fake relay that are throttled, defaults to 0.")
+@click.pass_obj
+def bench(settings: Configuration, homes, slots, interval, database, latency, error_rate, throttle_rate):  # pylint: disable=too-many-arguments
+    """ Measure the polling of fake relays, which never calls the Netatmo API. """
+    print(f"benchmarking the {settings.engine} engine")
+    report = benchmark.benchmark(homes=homes, slots=slots, interval=interval, database=database,
+                                 engine=settings.engine, workers=settings.workers, batch_size=settings.batch_size,
+                                 batch_delay=settings.batch_delay, api_rate=settings.api_rate,
+                                 api_burst=settings.api_burst, poll_window=settings.poll_window, storage=settings.storage,
+                                 compress=settings.compress, deadband=settings.deadband,
+                                 prepared=settings.prepared_inserts,
+                                 latency=latency, error_rate=error_rate, throttle_rate=throttle_rate)
+    print(report)
+
+
+def main(settings: Configuration, configure: Callable[[], Configuration]):
+    # signals can only be handled by the main thread, which asks the other threads to stop or to reload
+    lifecycle = Lifecycle()
+    lifecycle.install()
 
-def main(settings: Configuration):
     # start the thread that will repeatedly check for changes to the homes in the database
     #  and is responsible for spawning the required child threads to handle the polling of each Netatmo device
-    thread = Thread(target=run, args=(settings, 1 * 60 * 60), daemon=False, name="homes refresh")
+    thread = Thread(target=run, args=(settings, 1 * 60 * 60, lifecycle, configure), daemon=False, name="homes refresh")
     print("starting main thread")
     thread.start()
+    thread.join()
 
 
-def run(settings: Configuration, sleep_duration: int):
+def _engine(settings: Configuration) -> Engine:
     db_config = DBConfiguration(username=settings.db_username, password=settings.db_password,
                                 server=settings.db_server, database=settings.db_name,
-                                enable_debugging=settings.debug)
+                                enable_debugging=settings.debug, pool_size=settings.db_pool_size,
+                                max_overflow=settings.db_max_overflow, pool_timeout=settings.db_pool_timeout,
+                                pre_ping=settings.db_pre_ping, recycle=settings.db_recycle,
+                                statement_timeout=settings.db_statement_timeout)
+    return db_engine(db_config)
+
+
+def _writer(settings: Configuration, st_session: scoped_session) -> ReadingWriter:
+    return ReadingWriter(st_session=st_session, batch_size=settings.batch_size, batch_delay=settings.batch_delay,
+                         on_conflict=settings.on_conflict, storage=settings.storage,
+                         rollups=settings.rollups, compress=settings.compress, deadband=settings.deadband,
+                         spool=Spool(settings.spool) if settings.spool else None, prepared=settings.prepared_inserts)
+
+
+def _relays(settings: Configuration, tokens: Optional[TokenCache] = None) -> RelayPool:
+    limiter = RateLimiter(max_rate=settings.api_rate, burst=settings.api_burst)
+    return RelayPool(client_id=settings.client_id, client_secret=settings.client_secret, limiter=limiter,
+                     tokens=tokens)
 
-    engine = db_engine(db_config)
+
+def _refresh_tokens(relays: RelayPool, lifecycle: Lifecycle):
+    while not lifecycle.sleep(60):
+        try:
+            if refreshed := relays.refresh_tokens():
+                print(f"  refreshed {refreshed} Netatmo access tokens")
+        except Exception as err:  # pylint: disable=broad-except
+            logging.debug(f"Encountered an error refreshing the Netatmo access tokens: {err}\nRetrying later.")
+
+
+def _maintain_partitions(engine: Engine, settings: Configuration, sleep_duration: int, lifecycle: Lifecycle):
+    while True:
+        try:
+            partitions.maintain(engine, settings.retention_months)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.debug(f"Encountered an error maintaining the partitions: {err}\nRetrying later.")
+        if lifecycle.sleep(sleep_duration):
+            break
+
+
+# the settings that are applied while polling when the configuration is reloaded; others require a restart
+_LIVE_SETTINGS = {"api_rate", "api_burst", "batch_size", "batch_delay", "on_conflict", "retention_months", "drain_timeout"}
+
+
+def _reload(settings: Configuration, configure: Callable[[], Configuration], writer: ReadingWriter, relays: RelayPool):
+    print("  reloading the configuration")
+    try:
+        reloaded = configure()
+    except SystemExit:  # the reason has already been reported
+        print("  the configuration could not be reloaded, so the current configuration is kept")
+        return
+    except Exception as err:  # pylint: disable=broad-except
+        # e.g. a missing section or a value of the wrong type, which must not stop the polling
+        logging.error(f"The configuration could not be reloaded: {err!r}")
+        print("  the configuration could not be reloaded, so the current configuration is kept")
+        return
+
+    for name in Configuration.__annotations__:
+        if getattr(reloaded, name) == getattr(settings, name):
+            continue
+        if name in _LIVE_SETTINGS:
+            setattr(settings, name, getattr(reloaded, name))
+            print(f"  changed {name} to {getattr(settings, name)}")
+        else:
+            print(f"  changing {name} requires a restart")
+    relays.limiter.configure(max_rate=settings.api_rate, burst=settings.api_burst)
+    writer.configure(batch_size=settings.batch_size, batch_delay=settings.batch_delay, on_conflict=settings.on_conflict)
+
+
+def _shutdown(settings: Configuration, lifecycle: Lifecycle, writer: ReadingWriter, scheduler: SlotScheduler,
+              shard: Optional[Shard], home_interfaces: List[HomeInterface]):
+    # polls in progress may still hand their readings to the writer, after which the writer has until the deadline
+    deadline = lifecycle.deadline(settings.drain_timeout)
+    print("  stopping the polling of all homes")
+    scheduler.stop()
+    for h_i in home_interfaces:
+        h_i.stop()
+    for h_i in home_interfaces:
+        h_i.join(max(0.0, deadline - time.monotonic()))
+
+    if shard is not None:
+        try:
+            shard.stop()  # the other workers can take over the homes right away
+        except Exception as err:  # pylint: disable=broad-except
+            logging.debug(f"Encountered an error leaving the other workers: {err}")
+
+    print(f"  writing the {writer.backlog} remaining readings")
+    if not writer.drain(max(0.0, deadline - time.monotonic())):
+        print("  the writer is still waiting on the database, and stops once its write completes")
+    print("stopped")
+
+
+def run(settings: Configuration, sleep_duration: int, lifecycle: Lifecycle, configure: Callable[[], Configuration]):
+    engine = _engine(settings)
     session_factory = sessionmaker(bind=engine)
     st_session: scoped_session = scoped_session(session_factory)
-    home_interfaces: Dict[HomeInterface] = {}
 
-    while True:
-        print("  checking homes for any changes")
-
-        # retrieve all homes, and only the most recent revision of each home
-        session: Session
-        with db_session(st_session) as session:
-            home_alias = aliased(Home)
-            homes = session.query(
-                Home
-            ).outerjoin(
-                home_alias, and_(Home.label == home_alias.label, Home.revision < home_alias.revision)
-            ).filter(
-                home_alias.revision == None  # noqa: E711
-            ).all()
-
-            for home in homes:
-                if home.label in home_interfaces:
-                    db_id, h_i = home_interfaces[home.label]  # get the home interface we currently have
-                    if home.id != db_id:  # if the id changed for the home with this label we need ...
-                        h_i.stop()  # ... stop it's background threads and ...
-                        del home_interfaces[home.label]  # ... remove its reference
-                if home.label not in home_interfaces:
-                    print(f"   -starting polling of the home with the label '{home.label}'")
-                    h_i = HomeInterface(home_db_id=home.id, st_session=st_session,
-                                        netatmo_refresh_token=home.relay.refreshToken,
-                                        client_id=settings.client_id, client_secret=settings.client_secret)
-                    home_interfaces[home.label] = (home.id, h_i)
-            print(f"  started/refreshed all home polling threads")
-            print()
-
-        sleep(sleep_duration)
+    # a single writer stores the readings of all homes in batches
+    writer = _writer(settings, st_session)
+    if not writer.check():
+        logging.error("The readings are not unique per relay, room, and slot, so run the `migrate` command first")
+        sys.exit(1)
+    writer.start()
+
+    # homes which share a relay also share its client and the values retrieved during each slot, while the access
+    #  tokens of the relays are cached in the database so that a restart need not refresh all of them
+    relays = _relays(settings, TokenCache(st_session))
+    Thread(target=_refresh_tokens, args=(relays, lifecycle), daemon=True, name="token refresh").start()
+    lifecycle.on_reload(partial(_reload, settings, configure, writer, relays))
+
+    if settings.metrics_port:
+        metrics.CallbackGauge("chai_writer_backlog", "The number of readings waiting to be written.",
+                              lambda: {(): writer.backlog})
+        metrics.CallbackGauge("chai_netatmo_api_rate", "The number of calls per second allowed to the Netatmo API.",
+                              lambda: {(): relays.limiter.rate})
+        metrics.CallbackGauge("chai_netatmo_api_headroom", "The fraction of the allowed Netatmo API rate left unused.",
+                              lambda: {(): relays.limiter.headroom})
+        metrics.CallbackGauge("chai_db_pool_in_use", "The number of database connections in use.",
+                              lambda: {(): engine.pool.checkedout()})
+        metrics.CallbackGauge("chai_db_pool_saturation", "The fraction of the database connections that are in use.",
+                              lambda: {(): engine.pool.checkedout() / max(1, settings.db_pool_size + max(0, settings.db_max_overflow))})
+        metrics.serve(settings.metrics_port)
+        print(f"  serving metrics on http://127.0.0.1:{settings.metrics_port}/metrics")
+
+    # partitions are created ahead of time, and old partitions dropped, while the readings are being polled
+    Thread(target=_maintain_partitions, args=(engine, settings, sleep_duration, lifecycle), daemon=True,
+           name="partition maintenance").start()
+
+    # a single scheduler spreads the polls of all homes evenly over each slot
+    scheduler = SlotScheduler(interval=Minutes.MIN_5.value * 60, window=settings.poll_window)
+    scheduler.start()
+
+    # in worker mode the homes are divided between all workers that share the database
+    shard = Shard(engine, lease=settings.lease) if settings.shard else None
+    if shard is not None:
+        shard.start()
+        print(f"  joined the other workers as '{shard.name}'")
+
+    if settings.engine == "asyncio":
+        # poll all homes from a single event loop instead of from one thread per home
+        polling_engine = AsyncPollingEngine(st_session=st_session, writer=writer, relays=relays, scheduler=scheduler,
+                                            api_workers=settings.workers, shard=shard)
+        asyncio.run(polling_engine.run(sleep_duration, settings.check_interval, lifecycle, lambda: settings.drain_timeout))
+        _shutdown(settings, lifecycle, writer, scheduler, shard, [])
+        return
+
+    home_interfaces: Dict[str, HomeInterface] = {}
+
+    def start(label: str, home_db_id: int, netatmo_id: int, refresh_token: str) -> bool:
+        try:
+            home_interfaces[label] = HomeInterface(home_db_id=home_db_id, netatmo_id=netatmo_id, writer=writer,
+                                                   relays=relays, netatmo_refresh_token=refresh_token, label=label,
+                                                   scheduler=scheduler)
+        except Exception as err:  # pylint: disable=broad-except
+            logging.debug(f"Could not prepare the relay of home with DB id {home_db_id}: {err}\nRetrying at the next full check.")
+            return False
+        return True
+
+    def stop(label: str) -> HomeInterface:
+        h_i = home_interfaces.pop(label)  # stop its background threads and remove its reference
+        h_i.stop()
+        return h_i
+
+    def wait(stopped: List[HomeInterface], timeout: float):
+        deadline = time.monotonic() + timeout
+        for h_i in stopped:
+            h_i.join(max(0.0, deadline - time.monotonic()))
+
+    reconciler = HomeReconciler(st_session=st_session, limiter=relays.limiter, shard=shard,
+                                sleep_duration=sleep_duration, start=start, stop=stop, wait=wait)
+    while not lifecycle.stopping:
+        reconciler.check(lifecycle.reloaded())
+        # the wait is cut short when the process is asked to stop or to reload
+        lifecycle.wait(settings.check_interval)
+
+    _shutdown(settings, lifecycle, writer, scheduler, shard, list(home_interfaces.values()))
 
 
 if __name__ == "__main__":
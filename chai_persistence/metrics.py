@@ -0,0 +1,228 @@
+# pylint: disable=line-too-long, missing-module-docstring, too-few-public-methods
+# pylint: disable=loop-invariant-statement
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Sequence, Tuple
+
+_REGISTRY: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    """ Escape a label value for the Prometheus text format. """
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format(name: str, labels: Sequence[str], values: Tuple[str, ...], value: float, extra: str = "") -> str:
+    """ Format a single sample in the Prometheus text format. """
+    pairs = [f"{label}=\"{_escape(label_value)}\"" for label, label_value in zip(labels, values)]
+    if extra:
+        pairs.append(extra)
+    return f"{name}{{{','.join(pairs)}}} {value}" if pairs else f"{name} {value}"
+
+
+class _Metric:
+    """ A metric which is exposed in the Prometheus text format, optionally split by a number of labels. """
+    name: str
+    help: str
+    labels: Tuple[str, ...]
+    kind: str = "untyped"
+    _lock: threading.Lock
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        _REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self) -> List[str]:
+        """ Get the samples of this metric in the Prometheus text format. """
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        """ Get this metric in the Prometheus text format. """
+        return "\n".join([f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self.samples())
+
+
+class Counter(_Metric):
+    """ A value which only ever increases, such as the number of polls. """
+    kind = "counter"
+    _values: Dict[Tuple[str, ...], float]
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        """ Increase the counter for the given labels. """
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            return [_format(self.name, self.labels, key, value) for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """ A value which can go up and down, such as the moment of the last successful poll of a home. """
+    kind = "gauge"
+    _values: Dict[Tuple[str, ...], float]
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._values = {}
+
+    def set(self, value: float, **labels: str):
+        """ Set the gauge for the given labels. """
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def values(self) -> Dict[Tuple[str, ...], float]:
+        """ Get the current values of the gauge, indexed by their label values. """
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self) -> List[str]:
+        return [_format(self.name, self.labels, key, value) for key, value in self.values().items()]
+
+
+class CallbackGauge(_Metric):
+    """ A gauge of which the values are only determined when the metrics are collected, such as the size of a queue. """
+    kind = "gauge"
+    _callback: Callable[[], Dict[Tuple[str, ...], float]]
+
+    def __init__(self, name: str, help_text: str, callback: Callable[[], Dict[Tuple[str, ...], float]],
+                 labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._callback = callback
+
+    def samples(self) -> List[str]:
+        return [_format(self.name, self.labels, key, value) for key, value in self._callback().items()]
+
+
+class Histogram(_Metric):
+    """ The distribution of observed values, such as latencies, over a number of cumulative buckets. """
+    kind = "histogram"
+    _buckets: Tuple[float, ...]
+    _counts: Dict[Tuple[str, ...], List[int]]
+    _sums: Dict[Tuple[str, ...], float]
+
+    def __init__(self, name: str, help_text: str, buckets: Sequence[float], labels: Sequence[str] = ()):
+        super().__init__(name, help_text, labels)
+        self._buckets = tuple(sorted(buckets))
+        self._counts = {}
+        self._sums = {}
+
+    def observe(self, value: float, **labels: str):
+        """ Observe a value for the given labels. """
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self._buckets) + 1))
+            counts[bisect.bisect_left(self._buckets, value)] += 1
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    def time(self, **labels: str) -> "_Timer":
+        """ Get a context manager which observes the number of seconds spent within it. """
+        return _Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        samples = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                cumulative = 0
+                for bound, count in zip(self._buckets + (float("inf"),), counts):
+                    cumulative += count
+                    upper = "+Inf" if bound == float("inf") else repr(bound)
+                    samples.append(_format(f"{self.name}_bucket", self.labels, key, cumulative, f"le=\"{upper}\""))
+                samples.append(_format(f"{self.name}_sum", self.labels, key, self._sums[key]))
+                samples.append(_format(f"{self.name}_count", self.labels, key, cumulative))
+        return samples
+
+
+class _Timer:
+    """ A context manager which observes the number of seconds spent within it in a histogram. """
+    _histogram: Histogram
+    _labels: Dict[str, str]
+    _start: float
+
+    def __init__(self, histogram: Histogram, labels: Dict[str, str]):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *_):
+        self._histogram.observe(time.monotonic() - self._start, **self._labels)
+
+
+def render() -> str:
+    """ Get all metrics in the Prometheus text format. """
+    return "\n".join(metric.render() for metric in _REGISTRY) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ Serve all metrics on any path. """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *_):  # pylint: disable=arguments-differ
+        pass  # scrapes should not flood the output
+
+
+def serve(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Serve all metrics over HTTP in a background thread.
+    :param port: The port to serve the metrics on.
+    :param host: The address to serve the metrics on, which defaults to the local host only.
+    :return: The server, which can be shut down to stop serving the metrics.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+
+# the metrics of the hot paths; the latency buckets are in seconds
+
+API_LATENCY = Histogram("chai_netatmo_api_seconds", "The duration of calls to the Netatmo API.",
+                        buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+COMMIT_LATENCY = Histogram("chai_db_commit_seconds", "The duration of writing a batch of readings to the database.",
+                           buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+SLOT_TO_COMMIT = Histogram("chai_slot_mid_to_commit_seconds", "The time from the middle of a slot until its readings are committed.",
+                           buckets=(1, 5, 15, 30, 60, 120, 180, 300, 600, 1800))
+POLLS = Counter("chai_polls_total", "The number of polls of each home, by whether any value was retrieved.",
+                labels=("home", "result"))
+LAST_SUCCESS = Gauge("chai_last_success_timestamp_seconds", "The UNIX timestamp of the last successful poll of each home.",
+                     labels=("home",))
+LAG = CallbackGauge("chai_home_lag_seconds", "The number of seconds since the last successful poll of each home.",
+                    lambda: {key: time.time() - value for key, value in LAST_SUCCESS.values().items()}, labels=("home",))
+READINGS_WRITTEN = Counter("chai_readings_written_total", "The number of readings written to the database.")
+READINGS_SPOOLED = Counter("chai_readings_spooled_total", "The number of readings written to the spool instead of the database.")
+WRITE_FAILURES = Counter("chai_db_write_failures_total", "The number of batches that could not be written to the database.")
+POOL_WAIT = Histogram("chai_db_pool_checkout_seconds", "The time spent waiting for a connection from the database pool.",
+                      buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30))
+
+
+def record_poll(label: str, readings: Dict[int, float]):
+    """
+    Record the outcome of a poll of a home.
+    :param label: The label of the polled home.
+    :param readings: The values retrieved from the relay of the home.
+    """
+    POLLS.inc(home=label, result="success" if readings else "failure")
+    if readings:
+        LAST_SUCCESS.set(time.time(), home=label)
@@ -0,0 +1,146 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+from typing import Callable, List
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+
+from chai_persistence.db_definitions import NetatmoHourlyReading, NetatmoDailyReading, NetatmoToken, NetatmoWideReading, PersistenceWorker
+from chai_persistence.rollups import rebuild_rollups
+
+
+def stores_wide_rows(connection: Connection) -> bool:
+    """
+    Get whether the readings are stored as wide rows, in which case `netatmoreading` is a view.
+    :param connection: The database connection to use.
+    :return: True if the readings are stored as wide rows, False otherwise.
+    """
+    return connection.execute(text("SELECT EXISTS (SELECT 1 FROM pg_views WHERE viewname = 'netatmoreading')")).scalar()
+
+
+def has_unique_natural_key(connection: Connection) -> bool:
+    """
+    Get whether `ix_one_reading` enforces one reading per relay, room, and slot, on which inserts rely to ignore or
+    update readings that are already stored.
+    :param connection: The database connection to use.
+    :return: True if the index enforces the natural key, False otherwise.
+    """
+    definition = connection.execute(text(
+        "SELECT indexdef FROM pg_indexes WHERE tablename = 'netatmoreading' AND indexname = 'ix_one_reading'"
+    )).scalar()
+    return definition is not None and "(netatmoid, roomid, start)" in definition
+
+
+def unique_natural_key(connection: Connection):
+    """
+    Make `ix_one_reading` enforce one reading per relay, room, and slot rather than covering the primary key.
+    Duplicate readings are removed first, keeping the most recently inserted reading of each slot.
+    :param connection: The database connection to use, which is part of an ongoing transaction.
+    """
+    if has_unique_natural_key(connection) or stores_wide_rows(connection):
+        return  # the migration has already been applied, or wide rows are unique by definition
+
+    # prevent concurrent inserts from introducing new duplicates in between removing them and adding the index
+    connection.execute(text("LOCK TABLE netatmoreading IN SHARE ROW EXCLUSIVE MODE"))
+    removed = connection.execute(text(
+        "DELETE FROM netatmoreading WHERE id IN ("
+        "  SELECT id FROM ("
+        "    SELECT id, row_number() OVER (PARTITION BY netatmoid, roomid, start ORDER BY id DESC) AS duplicate"
+        "    FROM netatmoreading"
+        "  ) AS numbered WHERE duplicate > 1"
+        ")"
+    )).rowcount
+    print(f"   -removed {removed} duplicate readings")
+    connection.execute(text("DROP INDEX IF EXISTS ix_one_reading"))
+    connection.execute(text("CREATE UNIQUE INDEX ix_one_reading ON netatmoreading (netatmoid, roomid, start)"))
+
+
+def home_revision_index(connection: Connection):
+    """
+    Index the revisions of each home, so that the most recent revision of a single home can be found without a scan.
+    :param connection: The database connection to use, which is part of an ongoing transaction.
+    """
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_home_label_revision ON home (label, revision)"))
+
+
+def rollup_tables(connection: Connection):
+    """
+    Add the hourly and daily rollups of the readings, computing them from all readings that are already stored.
+    :param connection: The database connection to use, which is part of an ongoing transaction.
+    """
+    if inspect(connection).has_table(NetatmoDailyReading.__tablename__):
+        return  # the migration has already been applied
+    NetatmoHourlyReading.__table__.create(connection, checkfirst=True)
+    NetatmoDailyReading.__table__.create(connection)
+    rebuild_rollups(connection)
+
+
+def token_table(connection: Connection):
+    """
+    Add the table in which the access tokens of the relays are cached in between restarts.
+    :param connection: The database connection to use, which is part of an ongoing transaction.
+    """
+    NetatmoToken.__table__.create(connection, checkfirst=True)
+
+
+def worker_table(connection: Connection):
+    """
+    Add the table in which the workers that share the homes renew their lease.
+    :param connection: The database connection to use, which is part of an ongoing transaction.
+    """
+    PersistenceWorker.__table__.create(connection, checkfirst=True)
+
+
+def widen_readings(connection: Connection):
+    """
+    Store the readings as a single row per relay and slot in `netatmowidereading`, rather than a row per room.
+    The existing readings are moved, and `netatmoreading` is replaced by a view that presents the wide rows in the
+    original format, so that existing readers keep working. This migration is optional and not part of `MIGRATIONS`.
+    :param connection: The database connection to use, which is part of an ongoing transaction.
+    """
+    if stores_wide_rows(connection):
+        return  # the migration has already been applied
+
+    connection.execute(text("LOCK TABLE netatmoreading IN ACCESS EXCLUSIVE MODE"))
+    NetatmoWideReading.__table__.create(connection, checkfirst=True)
+    moved = connection.execute(text(
+        'INSERT INTO netatmowidereading (netatmoid, start, "end", thermostattemperature, valvetemperature, valvepercentage) '
+        'SELECT netatmoid, start, max("end"), '
+        '       max(reading) FILTER (WHERE roomid = 1), max(reading) FILTER (WHERE roomid = 2), '
+        '       max(reading) FILTER (WHERE roomid = 3) '
+        'FROM netatmoreading GROUP BY netatmoid, start '
+        'ON CONFLICT (netatmoid, start) DO NOTHING'
+    )).rowcount
+    print(f"   -moved the readings into {moved} wide rows")
+    connection.execute(text("DROP TABLE netatmoreading"))
+
+    # each wide row presents up to three readings, of which the ids are derived from the id of the row
+    connection.execute(text(
+        'CREATE VIEW netatmoreading AS '
+        'SELECT (wide.id - 1) * 3 + room.roomid AS id, room.roomid, wide.netatmoid, wide.start, wide."end", room.reading '
+        'FROM netatmowidereading AS wide '
+        'CROSS JOIN LATERAL (VALUES (1, wide.thermostattemperature), (2, wide.valvetemperature), '
+        '                           (3, wide.valvepercentage)) AS room (roomid, reading) '
+        'WHERE room.reading IS NOT NULL'
+    ))
+
+
+# the migrations in the order in which they need to be applied; every migration must be safe to apply repeatedly
+MIGRATIONS: List[Callable[[Connection], None]] = [
+    unique_natural_key,
+    home_revision_index,
+    rollup_tables,
+    token_table,
+    worker_table,
+]
+
+
+def migrate(engine: Engine):
+    """
+    Apply all migrations to the database, each in its own transaction.
+    :param engine: The database engine to use.
+    """
+    for migration in MIGRATIONS:
+        print(f"  applying migration {migration.__name__}")
+        with engine.begin() as connection:
+            migration(connection)
@@ -0,0 +1,145 @@
+# pylint: disable=line-too-long, missing-module-docstring
+# pylint: disable=loop-invariant-statement
+
+import re
+from typing import List, Optional
+
+from pendulum import DateTime, instance, now
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from chai_persistence.migrations import stores_wide_rows
+
+# the number of months ahead for which partitions are created, so that readings never lack a partition
+MONTHS_AHEAD = 3
+
+# the partition of each month is named after the month, e.g. `netatmoreading_y2022m11`
+_PARTITION_NAME = re.compile(r"^netatmoreading_y(\d{4})m(\d{2})$")
+
+
+def _partition_name(month: DateTime) -> str:
+    """ Get the name of the partition which holds the readings of the given month. """
+    return f"netatmoreading_y{month.year:04}m{month.month:02}"
+
+
+def is_partitioned(connection: Connection) -> bool:
+    """
+    Get whether the `netatmoreading` table is partitioned by month.
+    :param connection: The database connection to use.
+    :return: True if the table is partitioned, False otherwise.
+    """
+    return connection.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'netatmoreading'::regclass)"
+    )).scalar()
+
+
+def create_partitions(connection: Connection, months_ahead: int = MONTHS_AHEAD, start: Optional[DateTime] = None) -> int:
+    """
+    Create the monthly partitions of the `netatmoreading` table that do not exist yet.
+    :param connection: The database connection to use, which is part of an ongoing transaction.
+    :param months_ahead: The number of months after the current month for which a partition is created.
+    :param start: The moment from which partitions are created, defaults to the current month.
+    :return: The number of partitions that were created.
+    """
+    month = (start or now("Europe/London")).in_tz("Europe/London").start_of("month")
+    last = now("Europe/London").start_of("month").add(months=months_ahead)
+    existing = set(_partitions(connection))
+    created = 0
+    while month <= last:
+        following = month.add(months=1)
+        if _partition_name(month) not in existing:
+            connection.execute(text(
+                f"CREATE TABLE {_partition_name(month)} PARTITION OF netatmoreading "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{following.isoformat()}')"
+            ))
+            created += 1
+        month = following
+    return created
+
+
+def _partitions(connection: Connection) -> List[str]:
+    """ Get the names of the monthly partitions of the `netatmoreading` table. """
+    return list(connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class AS parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = 'netatmoreading'"
+    )).scalars())
+
+
+def drop_partitions(connection: Connection, retention_months: int) -> List[str]:
+    """
+    Drop the partitions of which all readings are older than the retention period. The rollups are kept.
+    :param connection: The database connection to use, which is part of an ongoing transaction.
+    :param retention_months: The number of whole months before the current month of which the readings are kept.
+    :return: The names of the partitions that were dropped.
+    """
+    cutoff = now("Europe/London").start_of("month").subtract(months=retention_months)
+    dropped = []
+    for name in _partitions(connection):
+        if (match := _PARTITION_NAME.match(name)) and (int(match[1]), int(match[2])) < (cutoff.year, cutoff.month):
+            connection.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    return dropped
+
+
+def partition_readings(connection: Connection):
+    """
+    Turn the `netatmoreading` table into a table partitioned by month, with BRIN indexes on the start and end of each
+    reading. All readings are copied into the new table, which takes an exclusive lock for the duration.
+    :param connection: The database connection to use, which is part of an ongoing transaction.
+    """
+    if is_partitioned(connection):
+        return  # the migration has already been applied
+    if stores_wide_rows(connection):
+        print("   -the readings are stored as wide rows, which are not partitioned")
+        return
+
+    connection.execute(text("LOCK TABLE netatmoreading IN ACCESS EXCLUSIVE MODE"))
+    sequence = connection.execute(text("SELECT pg_get_serial_sequence('netatmoreading', 'id')")).scalar()
+    oldest = connection.execute(text("SELECT min(start) FROM netatmoreading")).scalar()
+
+    # the existing table and its indexes are renamed, so that the new table can take over their names
+    connection.execute(text("ALTER TABLE netatmoreading RENAME TO netatmoreading_unpartitioned"))
+    for index in ("netatmoreading_pkey", "ix_one_reading", "ix_netatmoreading_start", "ix_netatmoreading_end"):
+        connection.execute(text(f"ALTER INDEX IF EXISTS {index} RENAME TO {index}_unpartitioned"))
+
+    # the primary key of a partitioned table must include the column by which it is partitioned
+    connection.execute(text(
+        "CREATE TABLE netatmoreading ("
+        f"  id integer NOT NULL DEFAULT nextval('{sequence}'),"
+        "  roomid integer NOT NULL,"
+        "  netatmoid integer NOT NULL REFERENCES netatmodevice (id),"
+        "  start timestamptz NOT NULL,"
+        '  "end" timestamptz NOT NULL,'
+        "  reading double precision NOT NULL,"
+        "  PRIMARY KEY (id, start)"
+        ") PARTITION BY RANGE (start)"
+    ))
+    connection.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY netatmoreading.id"))
+    connection.execute(text("CREATE UNIQUE INDEX ix_one_reading ON netatmoreading (netatmoid, roomid, start)"))
+    connection.execute(text("CREATE INDEX ix_netatmoreading_start ON netatmoreading USING brin (start)"))
+    connection.execute(text('CREATE INDEX ix_netatmoreading_end ON netatmoreading USING brin ("end")'))
+    print(f"   -created {create_partitions(connection, start=instance(oldest) if oldest else None)} partitions")
+
+    copied = connection.execute(text(
+        'INSERT INTO netatmoreading (id, roomid, netatmoid, start, "end", reading) '
+        'SELECT id, roomid, netatmoid, start, "end", reading FROM netatmoreading_unpartitioned'
+    )).rowcount
+    print(f"   -copied {copied} readings")
+    connection.execute(text("DROP TABLE netatmoreading_unpartitioned"))
+
+
+def maintain(engine: Engine, retention_months: int = 0):
+    """
+    Create the partitions of the coming months and drop the partitions beyond the retention period, if partitioned.
+    :param engine: The database engine to use.
+    :param retention_months: The number of whole months of readings to keep before the current month, 0 to keep all.
+    """
+    with engine.begin() as connection:
+        if stores_wide_rows(connection) or not is_partitioned(connection):
+            return
+        create_partitions(connection)
+        if retention_months > 0:
+            for name in drop_partitions(connection, retention_months):
+                print(f"  dropped partition {name}")
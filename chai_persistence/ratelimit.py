@@ -0,0 +1,164 @@
+# pylint: disable=line-too-long, missing-module-docstring, too-many-instance-attributes
+# pylint: disable=loop-invariant-statement, loop-try-except-usage
+
+import threading
+import time
+from collections import deque
+from logging import debug
+from typing import Callable, Deque, Optional, TypeVar
+
+from chai_data_sources.exceptions import NetatmoError
+
+from chai_persistence.metrics import API_LATENCY
+
+T = TypeVar("T")
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when a call to the Netatmo API cannot be made before its deadline. """
+
+
+def is_throttling(err: NetatmoError) -> bool:
+    """
+    Get whether an error indicates that the Netatmo API is throttling the calls being made.
+    :param err: The error raised by the Netatmo client.
+    :return: True if the error indicates throttling, False otherwise.
+    """
+    if getattr(err, "status_code", None) == 429:
+        return True
+    message = str(err).lower()
+    return "429" in message or "rate limit" in message or "too many requests" in message or "usage reached" in message
+
+
+class RateLimiter:
+    """
+    Limit the rate of all calls to the Netatmo API made by this process through a token bucket.
+    The rate adapts to the API: it increases additively with every successful call, up to `max_rate` calls per second,
+    and it is halved (at most once per second) whenever the API indicates it is throttling calls. Throttled calls are
+    retried with an exponential backoff for as long as the retry can still complete before the deadline of the call.
+    """
+    _max_rate: float
+    _min_rate: float
+    _increase: float
+    _burst: float
+    _rate: float
+    _tokens: float
+    _updated: float
+    _last_decrease: float
+    _calls: Deque[float]
+    _lock: threading.Lock
+    _window: float = 60.0
+
+    def __init__(self, *, max_rate: float = 10.0, burst: float = 20.0, min_rate: float = 0.1):
+        self._max_rate = max_rate
+        self._min_rate = min(min_rate, max_rate)
+        self._increase = max_rate / 50
+        self._burst = max(burst, 1.0)
+        self._rate = max_rate
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._last_decrease = 0.0
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def configure(self, *, max_rate: float, burst: float):
+        """
+        Change the limits while calls are being made, e.g. when the configuration is reloaded.
+        :param max_rate: The maximum number of calls per second.
+        :param burst: The maximum number of calls made in a burst.
+        """
+        with self._lock:
+            self._max_rate = max_rate
+            self._min_rate = min(self._min_rate, max_rate)
+            self._increase = max_rate / 50
+            self._burst = max(burst, 1.0)
+            self._rate = min(self._rate, max_rate)
+            self._tokens = min(self._tokens, self._burst)
+
+    @property
+    def rate(self) -> float:
+        """ Get the current number of calls per second that are allowed. """
+        return self._rate
+
+    @property
+    def usage(self) -> float:
+        """ Get the number of calls per second that were made, on average over the last minute. """
+        with self._lock:
+            self._forget(time.monotonic())
+            return len(self._calls) / self._window
+
+    @property
+    def headroom(self) -> float:
+        """ Get the fraction of the current rate that was not used over the last minute, between 0 and 1. """
+        return max(0.0, 1.0 - self.usage / self._rate)
+
+    def _forget(self, now: float):
+        """ Forget the calls that no longer count towards the usage. """
+        while self._calls and self._calls[0] < now - self._window:
+            self._calls.popleft()
+
+    def acquire(self, deadline: Optional[float] = None) -> bool:
+        """
+        Wait until a call may be made.
+        :param deadline: The UNIX timestamp by which the call must be made, if any.
+        :return: True if the call may be made, False if it cannot be made before the deadline.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self._calls.append(now)
+                    self._forget(now)
+                    return True
+                wait = (1 - self._tokens) / self._rate
+            if deadline is not None and time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def succeeded(self):
+        """ Indicate that a call succeeded, which additively increases the rate. """
+        with self._lock:
+            self._rate = min(self._max_rate, self._rate + self._increase)
+
+    def throttled(self):
+        """ Indicate that a call was throttled, which halves the rate unless it was just halved. """
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_decrease >= 1.0:
+                self._rate = max(self._min_rate, self._rate / 2)
+                self._last_decrease = now
+                debug("throttled by the Netatmo API, reducing the rate to %.2f calls per second", self._rate)
+
+    def call(self, function: Callable[[], T], deadline: Optional[float] = None, retries: int = 5) -> T:
+        """
+        Make a call to the Netatmo API, waiting for the rate limit and retrying the call while it is being throttled.
+        :param function: The function that makes the call.
+        :param deadline: The UNIX timestamp by which the call must complete, if any.
+        :param retries: The maximum number of times a throttled call is retried.
+        :return: The result of the call.
+        :raises DeadlineExceeded: When the call cannot be made before the deadline.
+        :raises NetatmoError: When the call fails for any other reason than throttling, or keeps being throttled.
+        """
+        backoff = 1.0
+        attempt = 0
+        while True:
+            if not self.acquire(deadline):
+                raise DeadlineExceeded()
+            try:
+                with API_LATENCY.time():
+                    result = function()
+            except NetatmoError as err:
+                if not is_throttling(err) or attempt >= retries:
+                    raise
+                self.throttled()
+                if deadline is not None and time.time() + backoff > deadline:
+                    raise DeadlineExceeded() from err
+                time.sleep(backoff)
+                backoff *= 2
+                attempt += 1
+                continue
+            self.succeeded()
+            return result
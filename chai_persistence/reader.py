@@ -0,0 +1,190 @@
+# pylint: disable=line-too-long, missing-module-docstring, too-many-arguments, too-many-locals
+
+from dataclasses import dataclass
+from typing import Dict, Optional, Sequence, Tuple
+
+import numpy as np
+from pendulum import DateTime, from_timestamp
+from sqlalchemy import bindparam, text
+from sqlalchemy.engine import Connection
+
+# the readings of each home are those of the relay that was installed in the home at the time, as given by the
+#  revisions of the home; all columns are numbers (the homes are numbered in the order of their labels, and the times
+#  are UNIX timestamps) so that each chunk of rows can be turned into a single array
+_LABELS_QUERY = text("""
+SELECT DISTINCT label FROM home WHERE :all_labels OR label IN :labels ORDER BY label
+""").bindparams(bindparam("labels", expanding=True))
+
+_READINGS_QUERY = text("""
+WITH relay AS (
+    SELECT dense_rank() OVER (ORDER BY home.label) - 1 AS home, home.netatmoid, home.revision AS active_from,
+           coalesce(min(newer.revision), 'infinity') AS active_until
+    FROM home
+    LEFT JOIN home AS newer ON newer.label = home.label AND newer.revision > home.revision
+    WHERE :all_labels OR home.label IN :labels
+    GROUP BY home.id, home.label, home.netatmoid, home.revision
+)
+SELECT relay.home, reading.roomid, extract(epoch FROM reading.start)::double precision,
+       extract(epoch FROM reading."end")::double precision, reading.reading
+FROM netatmoreading AS reading
+JOIN relay ON reading.netatmoid = relay.netatmoid
+          AND reading.start >= relay.active_from AND reading.start < relay.active_until
+WHERE reading."end" > :start AND reading.start < :end
+""").bindparams(bindparam("labels", expanding=True))
+
+
+@dataclass
+class Series:
+    """
+    The readings of a single room of a home, aligned to consecutive slots. Slots without a reading hold NaN, and slots
+    of which the reading was inferred rather than retrieved are marked in `inferred`.
+    """
+    start: DateTime  # the start of the first slot
+    interval: int  # the length of each slot in seconds
+    values: np.ndarray
+    inferred: np.ndarray
+
+    @property
+    def times(self) -> np.ndarray:
+        """ Get the start of each slot as a UNIX timestamp. """
+        return self.start.int_timestamp + self.interval * np.arange(len(self.values), dtype=np.int64)
+
+    @property
+    def missing(self) -> np.ndarray:
+        """ Get which slots have neither a retrieved nor an inferred reading. """
+        return np.isnan(self.values)
+
+
+def read_readings(connection: Connection, start: DateTime, end: DateTime, interval: int = 300,
+                  labels: Optional[Sequence[str]] = None, chunk_size: int = 100000,
+                  dtype: type = np.float64) -> Dict[str, Dict[int, Series]]:
+    """
+    Read the readings of homes for a time range as arrays aligned to slots, one for each room id of each home.
+    The rows are streamed from the database in chunks and placed in the arrays directly, so that no objects are created
+    for individual readings. Readings which span several slots (when runs are compressed) fill each slot they span.
+    :param connection: The database connection to use.
+    :param start: The start of the time range, which is rounded down to the start of its slot.
+    :param end: The end of the time range (exclusive), which is rounded up to the end of its slot.
+    :param interval: The length of each slot in seconds.
+    :param labels: The labels of the homes to read, defaults to all homes.
+    :param chunk_size: The number of rows fetched from the database at once.
+    :param dtype: The type of the values, e.g. `np.float32` to halve the memory that is used.
+    :return: The series of each room id, indexed by the label of the home.
+    """
+    first = start.int_timestamp // interval * interval
+    slots = -(-(end.int_timestamp - first) // interval)
+    origin = from_timestamp(first, tz=start.timezone_name or "Europe/London")
+    parameters = {"all_labels": labels is None, "labels": list(labels or [""]),
+                  "start": from_timestamp(first), "end": from_timestamp(first + slots * interval)}
+    homes = list(connection.execute(_LABELS_QUERY, parameters).scalars())
+    series: Dict[Tuple[int, int], np.ndarray] = {}
+
+    result = connection.execution_options(stream_results=True).execute(_READINGS_QUERY, parameters)
+    for rows in result.partitions(chunk_size):
+        chunk = np.array(rows, dtype=np.float64).reshape(-1, 5)
+
+        # each reading covers the slots from its start until its end, clipped to the time range
+        first_slot = np.maximum((chunk[:, 2] - first) // interval, 0).astype(np.int64)
+        last_slot = np.minimum(-(-(chunk[:, 3] - first) // interval), slots).astype(np.int64)
+        spans = np.maximum(last_slot - first_slot, 0)
+        home = np.repeat(chunk[:, 0].astype(np.int64), spans)
+        room = np.repeat(chunk[:, 1].astype(np.int64), spans)
+        index = np.repeat(first_slot - np.cumsum(spans) + spans, spans) + np.arange(spans.sum())
+        values = np.repeat(chunk[:, 4], spans)
+
+        # the slots of each home and room are placed in their array at once
+        order = np.lexsort((room, home))
+        home, room, index, values = home[order], room[order], index[order], values[order]
+        boundaries = np.flatnonzero((np.diff(home) != 0) | (np.diff(room) != 0)) + 1
+        for low, high in zip(np.r_[0, boundaries], np.r_[boundaries, len(home)]):
+            if low < high:
+                key = (int(home[low]), int(room[low]))
+                if key not in series:
+                    series[key] = np.full(slots, np.nan, dtype=dtype)
+                series[key][index[low:high]] = values[low:high]
+
+    readings: Dict[str, Dict[int, Series]] = {}
+    for (home, room), values in sorted(series.items()):
+        readings.setdefault(homes[home], {})[room] = Series(origin, interval, values, np.zeros(slots, dtype=bool))
+    return readings
+
+
+def read_home(connection: Connection, label: str, start: DateTime, end: DateTime, interval: int = 300) -> Dict[int, Series]:
+    """
+    Read the readings of a single home for a time range as arrays aligned to slots, one for each room id.
+    :param connection: The database connection to use.
+    :param label: The label of the home.
+    :param start: The start of the time range, which is rounded down to the start of its slot.
+    :param end: The end of the time range (exclusive), which is rounded up to the end of its slot.
+    :param interval: The length of each slot in seconds.
+    :return: The series of each room id, which is empty if the home has no readings.
+    """
+    return read_readings(connection, start, end, interval, labels=[label]).get(label, {})
+
+
+def fill(series: Series, method: str = "linear", limit: Optional[int] = None) -> Series:
+    """
+    Infer the missing readings of a series, either by linear interpolation or by holding the last reading.
+    Missing readings before the first reading are never inferred, nor are missing readings after the last reading when
+    interpolating linearly.
+    :param series: The series of which to infer the missing readings.
+    :param method: Either "linear" to interpolate in between two readings, or "hold" to repeat the last reading.
+    :param limit: The largest number of consecutive missing readings to infer, defaults to any number.
+    :return: A new series in which the inferred readings are marked.
+    """
+    values = series.values
+    known = ~np.isnan(values)
+    positions = np.arange(len(values))
+    previous = np.maximum.accumulate(np.where(known, positions, -1))
+    following = np.minimum.accumulate(np.where(known, positions, len(values))[::-1])[::-1]
+
+    if method == "hold":
+        target = ~known & (previous >= 0)
+        filled = np.where(target, values[np.maximum(previous, 0)], values)
+    elif method == "linear":
+        target = ~known & (previous >= 0) & (following < len(values))
+        filled = values.copy()
+        filled[target] = np.interp(positions[target], positions[known], values[known])
+    else:
+        raise ValueError(f"unknown fill method '{method}'")
+
+    if limit is not None:
+        # a gap is only filled if it is short enough, which is determined by the readings on either side of it
+        target &= (following - previous - 1) <= limit
+        filled = np.where(target | known, filled, np.nan)
+    return Series(series.start, series.interval, filled.astype(values.dtype), series.inferred | target)
+
+
+def resample(series: Series, interval: int, how: str = "mean") -> Series:
+    """
+    Combine the readings of a series into longer slots, ignoring the missing readings.
+    :param series: The series to resample.
+    :param interval: The length of the new slots in seconds, which must be a multiple of the current length.
+    :param how: Either "mean", "min", "max", or "last" to combine the readings of each new slot.
+    :return: A new series, of which a reading is marked as inferred if any reading it combines was inferred.
+    """
+    if interval % series.interval:
+        raise ValueError(f"cannot resample slots of {series.interval} seconds into slots of {interval} seconds")
+    factor = interval // series.interval
+    buckets = -(-len(series.values) // factor)
+    values = np.full(buckets * factor, np.nan, dtype=series.values.dtype)
+    values[:len(series.values)] = series.values
+    values = values.reshape(buckets, factor)
+    inferred = np.zeros(buckets * factor, dtype=bool)
+    inferred[:len(series.inferred)] = series.inferred
+
+    known = ~np.isnan(values)
+    count = known.sum(axis=1)
+    if how == "mean":
+        combined = np.where(known, values, 0).sum(axis=1) / np.where(count > 0, count, 1)
+    elif how == "min":
+        combined = np.where(known, values, np.inf).min(axis=1)
+    elif how == "max":
+        combined = np.where(known, values, -np.inf).max(axis=1)
+    elif how == "last":
+        last = factor - 1 - np.argmax(known[:, ::-1], axis=1)
+        combined = values[np.arange(buckets), last]
+    else:
+        raise ValueError(f"unknown resampling '{how}'")
+    combined = np.where(count > 0, combined, np.nan).astype(series.values.dtype)
+    return Series(series.start, interval, combined, inferred.reshape(buckets, factor).any(axis=1))
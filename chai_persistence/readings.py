@@ -0,0 +1,107 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+from dataclasses import dataclass
+from functools import partial
+from logging import debug
+from typing import Dict, Iterable, Iterator, List, Any, Optional, Tuple
+
+from chai_data_sources import NetatmoClient
+from chai_data_sources.exceptions import NetatmoError
+from pendulum import DateTime
+
+from chai_persistence.ratelimit import RateLimiter, DeadlineExceeded
+from chai_persistence.utilities import Slot
+
+# the room ids under which each of the values of a relay is stored
+THERMOSTAT_TEMPERATURE = 1
+VALVE_TEMPERATURE = 2
+VALVE_PERCENTAGE = 3
+
+# the columns of the `netatmowidereading` table which hold the value of each room id
+WIDE_COLUMNS = {THERMOSTAT_TEMPERATURE: "thermostattemperature",
+                VALVE_TEMPERATURE: "valvetemperature",
+                VALVE_PERCENTAGE: "valvepercentage"}
+
+
+@dataclass(frozen=True)
+class Reading:
+    """ A single value retrieved from a Netatmo relay, as it is stored in the `netatmoreading` table. """
+    netatmo_id: int
+    room_id: int
+    start: DateTime
+    end: DateTime
+    reading: float
+
+    @property
+    def key(self) -> Tuple[int, int, DateTime]:
+        """ Get the natural key of this reading, of which the `netatmoreading` table holds at most one row. """
+        return self.netatmo_id, self.room_id, self.start
+
+    def as_row(self) -> Dict[str, Any]:
+        """ Get this reading as a row of the `netatmoreading` table, indexed by column name. """
+        return {"netatmoid": self.netatmo_id, "roomid": self.room_id,
+                "start": self.start, "end": self.end, "reading": self.reading}
+
+
+def fetch_readings(relay: NetatmoClient, limiter: RateLimiter, deadline: Optional[float] = None) -> Dict[int, float]:
+    """
+    Retrieve a snapshot of the current thermostat temperature, valve temperature, and valve percentage of a relay.
+    This call is blocking as the values are retrieved from the Netatmo API.
+    :param relay: The client of the Netatmo relay to retrieve the values from.
+    :param limiter: The rate limiter through which all calls to the Netatmo API are made.
+    :param deadline: The UNIX timestamp by which the values must be retrieved, if any.
+    :return: The retrieved values indexed by their room id. Values that could not be retrieved are omitted.
+    """
+    readings = {}
+    for room_id, attribute in ((THERMOSTAT_TEMPERATURE, "thermostat_temperature"),
+                               (VALVE_TEMPERATURE, "t3_temperature"),
+                               (VALVE_PERCENTAGE, "valve_percentage")):
+        try:
+            readings[room_id] = limiter.call(partial(getattr, relay, attribute), deadline)
+        except (NetatmoError, DeadlineExceeded) as err:
+            debug(f"could not retrieve {attribute}: {err!r}")
+    return readings
+
+
+def to_readings(netatmo_id: int, slot: Slot, values: Dict[int, float]) -> List[Reading]:
+    """
+    Turn the values retrieved from a relay into readings that can be stored.
+    :param netatmo_id: The database id of the Netatmo relay the values were retrieved from.
+    :param slot: The slot during which the values were retrieved.
+    :param values: The retrieved values indexed by their room id.
+    :return: A reading for each of the retrieved values.
+    """
+    return [Reading(netatmo_id, room_id, slot.start, slot.end, value) for room_id, value in values.items()]
+
+
+def to_wide_rows(readings: Iterable[Reading]) -> List[Dict[str, Any]]:
+    """
+    Combine the readings of each relay during the same slot into a single row of the `netatmowidereading` table.
+    :param readings: The readings to combine, where later readings overwrite earlier readings of the same room.
+    :return: The rows indexed by column name, where the values that were not retrieved are None.
+    """
+    rows = {}
+    for reading in readings:
+        row = rows.setdefault((reading.netatmo_id, reading.start), {
+            "netatmoid": reading.netatmo_id, "start": reading.start, "end": reading.end,
+            **{column: None for column in WIDE_COLUMNS.values()}
+        })
+        row["end"] = reading.end
+        row[WIDE_COLUMNS[reading.room_id]] = reading.reading
+    return list(rows.values())
+
+
+def expand_runs(readings: Iterable[Reading], interval: int) -> Iterator[Reading]:
+    """
+    Expand readings that span several slots, as stored when runs of unchanged values are compressed, into a reading for
+    each slot. Readings that span a single slot are returned as is.
+    :param readings: The readings to expand.
+    :param interval: The length of each slot in seconds.
+    :return: The readings of each slot, in the order of the given readings.
+    """
+    for reading in readings:
+        start = reading.start
+        while start < reading.end:
+            end = start.add(seconds=interval)
+            yield Reading(reading.netatmo_id, reading.room_id, start, min(end, reading.end), reading.reading)
+            start = end
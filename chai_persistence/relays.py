@@ -0,0 +1,149 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import threading
+from concurrent.futures import Future
+from functools import partial
+from typing import Callable, Dict, Optional, Tuple
+
+from chai_data_sources import NetatmoClient
+from pendulum import DateTime
+
+from chai_persistence.ratelimit import RateLimiter
+from chai_persistence.readings import fetch_readings
+from chai_persistence.tokens import Token, TokenCache, reuse_client, token_of
+from chai_persistence.utilities import Slot
+
+
+class RelayPool:
+    """
+    Share the Netatmo relays between all homes, as several (revisions of) homes may use the same relay.
+    Each relay has a single client, and the values of a relay are retrieved at most once per slot: all homes which use
+    the same relay during a slot share the snapshot taken by whichever home polls the relay first. All calls to the
+    Netatmo API go through a single rate limiter. When a token cache is given, clients reuse the cached access tokens of
+    their relay, and access tokens are refreshed ahead of their expiry through `refresh_tokens`.
+    """
+    _client_id: str
+    _client_secret: str
+    _netatmo_target: Optional[str]
+    _limiter: RateLimiter
+    _client_factory: Callable[..., NetatmoClient]
+    _tokens: Optional[TokenCache]
+    _clients: Dict[int, NetatmoClient]
+    _creating: Dict[int, "Future[NetatmoClient]"]
+    _snapshots: Dict[int, Tuple[DateTime, "Future[Dict[int, float]]"]]
+    _lock: threading.Lock
+
+    def __init__(self, *, client_id: str, client_secret: str, limiter: RateLimiter,
+                 netatmo_target: Optional[str] = None, client_factory: Callable[..., NetatmoClient] = NetatmoClient,
+                 tokens: Optional[TokenCache] = None):
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._netatmo_target = netatmo_target
+        self._limiter = limiter
+        self._client_factory = client_factory  # replaced by a fake relay when benchmarking
+        self._tokens = tokens
+        self._clients = {}
+        self._creating = {}
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    @property
+    def limiter(self) -> RateLimiter:
+        """ Get the rate limiter through which all calls to the Netatmo API are made. """
+        return self._limiter
+
+    def client(self, netatmo_id: int, refresh_token: str) -> NetatmoClient:
+        """
+        Get the client of a relay, creating the client if this is the first home to use the relay.
+        :param netatmo_id: The database id of the relay.
+        :param refresh_token: The refresh token used to access the relay.
+        :return: The client of the relay.
+        """
+        with self._lock:
+            if netatmo_id in self._clients:
+                return self._clients[netatmo_id]
+            # the client is created outside of the lock, as this may take long (e.g. when throttled), while homes which
+            #  use the same relay wait for the same client
+            future = self._creating.get(netatmo_id)
+            owner = future is None
+            if owner:
+                future = self._creating[netatmo_id] = Future()
+
+        if owner:
+            try:
+                cached = self._tokens.get(netatmo_id) if self._tokens is not None else None
+                client = self._create(netatmo_id, refresh_token, cached)
+            except Exception as err:  # pylint: disable=broad-except
+                with self._lock:
+                    del self._creating[netatmo_id]  # a later call tries again
+                future.set_exception(err)
+            else:
+                with self._lock:
+                    self._clients[netatmo_id] = client
+                    del self._creating[netatmo_id]
+                future.set_result(client)
+        return future.result()
+
+    def _create(self, netatmo_id: int, refresh_token: str, cached: Optional[Token]) -> NetatmoClient:
+        """ Create the client of a relay, from its cached tokens if possible, and cache the tokens of the client. """
+        kwargs = {
+            "client_id": self._client_id,
+            "client_secret": self._client_secret,
+            "refresh_token": cached.refresh_token if cached is not None else refresh_token,  # it may have been rotated
+            **({"target": self._netatmo_target} if self._netatmo_target else {})
+        }
+        client = reuse_client(self._client_factory, cached, **kwargs)
+        if client is None:  # only refreshing an access token calls the Netatmo API
+            client = self._limiter.call(partial(self._client_factory, **kwargs))
+        if self._tokens is not None and (token := token_of(client)) is not None:
+            self._tokens.put(netatmo_id, token)
+        return client
+
+    def refresh_tokens(self, margin: float = 600) -> int:
+        """
+        Refresh the access tokens that expire soon by replacing their clients, so that polls never wait for a refresh.
+        Tokens which the clients refreshed by themselves in the meantime are cached as well.
+        :param margin: The number of seconds before their expiry at which access tokens are refreshed.
+        :return: The number of access tokens that were refreshed.
+        """
+        with self._lock:
+            clients = dict(self._clients)
+        refreshed = 0
+        for netatmo_id, client in clients.items():
+            token = token_of(client)
+            if token is None:
+                continue
+            if token.expires_within(margin):
+                # a new client refreshes the access token with the current (possibly rotated) refresh token
+                replacement = self._create(netatmo_id, token.refresh_token, None)
+                with self._lock:
+                    self._clients[netatmo_id] = replacement
+                refreshed += 1
+            elif self._tokens is not None:
+                self._tokens.put(netatmo_id, token)
+        return refreshed
+
+    def snapshot(self, netatmo_id: int, slot: Slot) -> Dict[int, float]:
+        """
+        Get the values of a relay during a slot, retrieving them only if no other home did so already for this slot.
+        This call blocks until the values are retrieved, either by this call or by a concurrent call for the same relay.
+        :param netatmo_id: The database id of the relay, of which the client must already exist.
+        :param slot: The slot for which to get the values.
+        :return: The values of the relay indexed by their room id. Values that could not be retrieved are omitted.
+        """
+        with self._lock:
+            # only the most recent slot of each relay is remembered, as earlier slots are no longer polled
+            retrieved, future = self._snapshots.get(netatmo_id, (None, None))
+            owner = retrieved != slot.start
+            if owner:
+                future = Future()
+                self._snapshots[netatmo_id] = (slot.start, future)
+            relay = self._clients[netatmo_id]
+
+        if owner:
+            try:
+                # the values must be retrieved before the end of the slot, as they are stored against the slot
+                future.set_result(fetch_readings(relay, self._limiter, deadline=slot.end.timestamp()))
+            except Exception as err:  # pylint: disable=broad-except
+                future.set_exception(err)
+        return future.result()
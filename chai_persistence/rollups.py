@@ -0,0 +1,75 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+from typing import Iterable, List, Optional, Union
+
+from pendulum import DateTime, instance
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from chai_persistence.readings import Reading
+
+# the hourly rollups are computed from the readings, while the daily rollups are computed from the hourly rollups;
+#  each bucket is recomputed in full, so updating the same bucket more than once is harmless; readings which span
+#  several slots (when runs of unchanged values are compressed) count once for every slot they span
+_HOURLY = text("""
+INSERT INTO netatmohourlyreading (netatmoid, roomid, start, count, minimum, mean, maximum)
+SELECT netatmoid, roomid, date_trunc('hour', slot.start) AS hour, count(*), min(reading), avg(reading), max(reading)
+FROM netatmoreading
+CROSS JOIN LATERAL generate_series(netatmoreading.start, netatmoreading."end" - make_interval(secs => :interval),
+                                   make_interval(secs => :interval)) AS slot (start)
+WHERE netatmoid = ANY(:relays) AND netatmoreading."end" > :start AND netatmoreading.start < :end
+  AND slot.start >= :start AND slot.start < :end
+GROUP BY netatmoid, roomid, hour
+ON CONFLICT (netatmoid, roomid, start) DO UPDATE
+SET count = excluded.count, minimum = excluded.minimum, mean = excluded.mean, maximum = excluded.maximum
+""")
+
+_DAILY = text("""
+INSERT INTO netatmodailyreading (netatmoid, roomid, start, count, minimum, mean, maximum)
+SELECT netatmoid, roomid, date_trunc('day', start, 'Europe/London') AS day,
+       sum(count), min(minimum), sum(mean * count) / sum(count), max(maximum)
+FROM netatmohourlyreading
+WHERE netatmoid = ANY(:relays) AND start >= :start AND start < :end
+GROUP BY netatmoid, roomid, day
+ON CONFLICT (netatmoid, roomid, start) DO UPDATE
+SET count = excluded.count, minimum = excluded.minimum, mean = excluded.mean, maximum = excluded.maximum
+""")
+
+
+def _update(connection: Union[Connection, Session], relays: List[int], start: DateTime, end: DateTime, interval: int):
+    """ Recompute the hourly and daily rollups of the given relays for the buckets that overlap the given time range. """
+    start, end = start.in_tz("Europe/London"), end.in_tz("Europe/London")
+    connection.execute(_HOURLY, {"relays": relays, "interval": interval, "start": start.start_of("hour"),
+                                 "end": end.start_of("hour").add(hours=1)})
+    connection.execute(_DAILY, {"relays": relays, "start": start.start_of("day"),
+                                "end": end.start_of("day").add(days=1)})
+
+
+def update_rollups(connection: Union[Connection, Session], readings: Iterable[Reading], interval: int = 300):
+    """
+    Update the rollups of the hours and days touched by newly stored readings, as part of the same transaction.
+    :param connection: The database connection or session to use, which stored the readings.
+    :param readings: The readings that were stored.
+    :param interval: The length of each slot in seconds.
+    """
+    readings = list(readings)
+    if readings:
+        _update(connection, sorted({reading.netatmo_id for reading in readings}),
+                min(reading.start for reading in readings), max(reading.start for reading in readings), interval)
+
+
+def rebuild_rollups(connection: Connection, start: Optional[DateTime] = None, end: Optional[DateTime] = None,
+                    interval: int = 300):
+    """
+    Recompute the rollups of all relays, e.g. once they are first created or after a backfill.
+    :param connection: The database connection to use.
+    :param start: The start of the time range to recompute, defaults to the oldest reading.
+    :param end: The end of the time range to recompute, defaults to the newest reading.
+    :param interval: The length of each slot in seconds.
+    """
+    oldest, newest = connection.execute(text('SELECT min(start), max("end") FROM netatmoreading')).one()
+    if oldest is None:
+        return
+    relays = list(connection.execute(text("SELECT id FROM netatmodevice")).scalars())
+    _update(connection, relays, start or instance(oldest), end or instance(newest), interval)
@@ -0,0 +1,113 @@
+# pylint: disable=line-too-long, missing-module-docstring
+# pylint: disable=loop-invariant-statement
+
+import heapq
+import threading
+import time
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+from chai_persistence.utilities import Slot, slot_at
+
+
+class SlotScheduler(threading.Thread):
+    """
+    Own the moment at which each home is next polled, rather than having every home wake up at the middle of a slot.
+    Polls are spread evenly over a window centred on the middle of each slot, where each home has a stable offset within
+    that window based on its label. The scheduler only signals that a home is due by calling its callback with the slot
+    that is being polled; callbacks must therefore return immediately, e.g. by handing the slot to a queue.
+    """
+    _interval: int
+    _window: float
+    _heap: List[Tuple[float, int, str, int, int]]  # due time, sequence, key, generation, and start of the slot
+    _callbacks: Dict[str, Tuple[Optional[Callable[[Slot], None]], int]]  # callback (None once removed) and generation of each key
+    _sequence: int
+    _condition: threading.Condition
+    _stop_event: threading.Event
+    _tz: str = "Europe/London"
+
+    def __init__(self, *, interval: int, window: float = 240):
+        super().__init__(name="slot scheduler", daemon=True)
+        self._interval = interval
+        self._window = min(max(window, 0), interval)
+        self._heap = []
+        self._callbacks = {}
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._stop_event = threading.Event()
+
+    @property
+    def stopped(self) -> bool:
+        """ Get whether this scheduler has been stopped. """
+        return self._stop_event.is_set()
+
+    def offset(self, key: str) -> float:
+        """
+        Get the stable offset of a home from the start of each slot.
+        :param key: The key identifying the home, such as its label.
+        :return: The number of seconds after the start of a slot at which the home is polled.
+        """
+        fraction = zlib.crc32(key.encode("utf-8")) / 2 ** 32
+        return (self._interval - self._window) / 2 + fraction * self._window
+
+    def _push(self, key: str, generation: int, slot_start: int):
+        """ Schedule the poll of a home for the slot starting at the given UNIX timestamp. """
+        self._sequence += 1
+        heapq.heappush(self._heap, (slot_start + self.offset(key), self._sequence, key, generation, slot_start))
+
+    def add(self, key: str, callback: Callable[[Slot], None]):
+        """
+        Start scheduling the polls of a home, starting with the first slot of which the poll is still due.
+        :param key: The key identifying the home, such as its label. Adding a key again replaces its callback.
+        :param callback: The callback which receives the slot to poll once a poll of the home is due.
+        """
+        with self._condition:
+            generation = self._callbacks.get(key, (None, 0))[1] + 1
+            self._callbacks[key] = (callback, generation)
+            slot_start = int(time.time() // self._interval) * self._interval
+            if slot_start + self.offset(key) <= time.time():
+                slot_start += self._interval
+            self._push(key, generation, slot_start)
+            self._condition.notify()
+
+    def remove(self, key: str):
+        """
+        Stop scheduling the polls of a home.
+        :param key: The key identifying the home.
+        """
+        with self._condition:
+            if key in self._callbacks:
+                # the generation is kept, so that the polls still scheduled for the key never become valid again
+                self._callbacks[key] = (None, self._callbacks[key][1])
+
+    def run(self):
+        """ Start scheduling the polls in a blocking way. Call `start()` instead for a non-blocking scheduler. """
+        while not self.stopped:
+            with self._condition:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                due, _, key, generation, slot_start = self._heap[0]
+                if due > time.time():
+                    self._condition.wait(due - time.time())
+                    continue
+                heapq.heappop(self._heap)
+                callback, current_generation = self._callbacks.get(key, (None, None))
+                if callback is None or generation != current_generation:
+                    continue  # the home has been removed or added again since this poll was scheduled
+                if slot_start + self._interval <= time.time():
+                    # the slot ended before it could be polled (e.g. after a suspend), so continue with the current slot
+                    self._push(key, generation, int(time.time() // self._interval) * self._interval)
+                    continue
+                self._push(key, generation, slot_start + self._interval)
+
+            try:
+                callback(slot_at(slot_start, self._interval, self._tz))
+            except Exception:  # pylint: disable=broad-except
+                pass  # a failing callback must never stop the polling of other homes
+
+    def stop(self):
+        """ Stop scheduling any polls. """
+        self._stop_event.set()
+        with self._condition:
+            self._condition.notify()
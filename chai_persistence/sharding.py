@@ -0,0 +1,206 @@
+# pylint: disable=line-too-long, missing-module-docstring, too-many-instance-attributes
+# pylint: disable=loop-invariant-statement, loop-try-except-usage
+
+import bisect
+import hashlib
+import os
+import socket
+import threading
+import time
+import zlib
+from logging import debug
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+# the advisory locks of the homes are taken within their own namespace, so they do not clash with other locks
+_LOCK_NAMESPACE = zlib.crc32(b"chai_persistence") - 2 ** 31
+
+# the label, database id, relay id, and relay refresh token of the most recent revision of a home
+HomeRow = Tuple[str, int, int, str]
+
+
+def _hash(key: str) -> int:
+    """ Get the position of a key on the ring, where MD5 spreads similar keys (e.g. labels) far more evenly than CRC32. """
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:4], "big")
+
+
+def _lock_key(label: str) -> int:
+    """ Get the key of the advisory lock of a home, which must fit in a signed 32-bit integer. """
+    return zlib.crc32(label.encode("utf-8")) - 2 ** 31
+
+
+class HashRing:
+    """
+    Assign keys to nodes through consistent hashing, so that only the keys of a node which joins or leaves move.
+    Each node is placed on the ring several times to spread the keys evenly.
+    """
+    _hashes: List[int]
+    _nodes: List[str]
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 64):
+        points = sorted((_hash(f"{node}#{replica}"), node) for node in nodes for replica in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        """
+        Get the node which owns a key.
+        :param key: The key, such as the label of a home.
+        :return: The node which owns the key, or None if there are no nodes.
+        """
+        if not self._nodes:
+            return None
+        return self._nodes[bisect.bisect(self._hashes, _hash(key)) % len(self._nodes)]
+
+
+class Shard:
+    """
+    Divide the homes between several workers, on one or several machines, which share the same database.
+    Every worker renews its lease in the `persistenceworker` table with a heartbeat, and workers of which the lease
+    expired are removed. The homes are assigned to the live workers through consistent hashing on their label, so homes
+    rebalance automatically when a worker joins or dies. A worker only polls a home while it holds an advisory lock on
+    the home, taken on a dedicated connection, so a home is never polled by two workers at once: the lock of a worker
+    that dies is released along with its connection, and a worker hands over a home by releasing the lock.
+    """
+    name: str
+    _engine: Engine
+    _lease: float
+    _ring: HashRing
+    _homes: Dict[str, HomeRow]
+    _owned: Set[str]
+    _connection: Optional[Connection]
+    _lock: threading.Lock
+    _stop_event: threading.Event
+    _last_heartbeat: float
+
+    def __init__(self, engine: Engine, lease: float = 30.0, name: Optional[str] = None):
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        self._engine = engine
+        self._lease = lease
+        self._ring = HashRing([])
+        self._homes = {}
+        self._owned = set()
+        self._connection = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._last_heartbeat = 0.0
+
+    @property
+    def lease(self) -> float:
+        """ Get the number of seconds after which a worker that stopped renewing its lease is considered dead. """
+        return self._lease
+
+    @property
+    def owned(self) -> Set[str]:
+        """ Get the labels of the homes this worker currently polls. """
+        with self._lock:
+            return set(self._owned)
+
+    def start(self):
+        """ Join the other workers, and keep renewing the lease of this worker in the background. """
+        self.heartbeat()
+        threading.Thread(target=self._beat, name="shard heartbeat", daemon=True).start()
+
+    def heartbeat(self):
+        """ Renew the lease of this worker, remove the workers of which the lease expired, and rebalance the homes. """
+        with self._engine.begin() as connection:
+            # the time of the database is used throughout, so that the clocks of the machines do not matter
+            connection.execute(text(
+                "INSERT INTO persistenceworker (name, heartbeat) VALUES (:name, now()) "
+                "ON CONFLICT (name) DO UPDATE SET heartbeat = now()"
+            ), {"name": self.name})
+            connection.execute(text("DELETE FROM persistenceworker WHERE heartbeat < now() - make_interval(secs => :lease)"),
+                               {"lease": self._lease})
+            workers = list(connection.execute(text("SELECT name FROM persistenceworker")).scalars())
+        with self._lock:
+            self._ring = HashRing(workers)
+            self._last_heartbeat = time.monotonic()
+
+    def _beat(self):
+        while not self._stop_event.wait(self._lease / 3):
+            try:
+                self.heartbeat()
+            except Exception as err:  # pylint: disable=broad-except
+                debug(f"Encountered an error renewing the lease of worker {self.name}: {err}\nRetrying shortly.")
+                with self._lock:
+                    if time.monotonic() - self._last_heartbeat > self._lease:
+                        self._ring = HashRing([])  # other workers may have taken over, so all homes are released
+
+    def _try_lock(self, label: str) -> bool:
+        """ Try to take the advisory lock of a home, reconnecting if the dedicated connection was lost. """
+        if self._connection is None:
+            self._connection = self._engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+        return self._connection.execute(text("SELECT pg_try_advisory_lock(:namespace, :key)"),
+                                        {"namespace": _LOCK_NAMESPACE, "key": _lock_key(label)}).scalar()
+
+    def assign(self, homes: Iterable[HomeRow]) -> Tuple[List[HomeRow], List[str]]:
+        """
+        Remember the homes which changed, and determine which homes this worker should start and stop polling.
+        :param homes: The most recent revision of each home which changed, or of all homes.
+        :return: The given homes which this worker owns, along with the homes which this worker just took over, and the
+                 labels of the homes this worker should stop polling and `release` afterwards.
+        """
+        changed = {home[0]: home for home in homes}
+        with self._lock:
+            self._homes.update(changed)
+            ring = self._ring
+            owned = set(self._owned)
+
+        started, released = [], []
+        try:
+            for label, home in self._homes.items():
+                if ring.owner(label) != self.name:
+                    if label in owned:
+                        released.append(label)
+                elif label in owned:
+                    if label in changed:
+                        started.append(home)
+                elif self._try_lock(label):
+                    owned.add(label)
+                    started.append(home)
+        except Exception as err:  # pylint: disable=broad-except
+            # the locks are lost with the connection, so all homes are released and taken again once reconnected
+            debug(f"Encountered an error taking the locks of worker {self.name}: {err}\nReleasing all homes.")
+            self._disconnect()
+            started, released, owned = [], sorted(owned), set()
+        with self._lock:
+            self._owned = owned
+        return started, released
+
+    def release(self, labels: Iterable[str]):
+        """
+        Release homes which this worker no longer polls, so that their new owner can take them.
+        :param labels: The labels of the homes to release.
+        """
+        labels = list(labels)
+        with self._lock:
+            self._owned.difference_update(labels)
+        if self._connection is None:
+            return
+        try:
+            for label in labels:
+                self._connection.execute(text("SELECT pg_advisory_unlock(:namespace, :key)"),
+                                         {"namespace": _LOCK_NAMESPACE, "key": _lock_key(label)})
+        except Exception as err:  # pylint: disable=broad-except
+            debug(f"Encountered an error releasing the locks of worker {self.name}: {err}")
+            self._disconnect()
+
+    def _disconnect(self):
+        """ Close the dedicated connection, which releases all advisory locks of this worker. """
+        with self._lock:
+            self._owned.clear()
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:  # pylint: disable=broad-except
+                pass  # the connection is most likely broken already
+            self._connection = None
+
+    def stop(self):
+        """ Leave the other workers, releasing all homes, so that they can take over right away. """
+        self._stop_event.set()
+        self._disconnect()
+        with self._engine.begin() as connection:
+            connection.execute(text("DELETE FROM persistenceworker WHERE name = :name"), {"name": self.name})
@@ -0,0 +1,102 @@
+# pylint: disable=line-too-long, missing-module-docstring
+# pylint: disable=loop-invariant-statement
+
+import glob
+import os
+import struct
+import threading
+import time
+from logging import debug
+from typing import BinaryIO, Callable, Iterator, List, Optional
+
+from pendulum import from_timestamp
+
+from chai_persistence.readings import Reading
+
+# each reading is stored as its relay id, room id, start and end (as UNIX timestamps), and value
+_RECORD = struct.Struct("<iBqqd")
+
+
+class Spool:
+    """
+    Keep readings in a local, append-only file while they cannot be written to the database.
+    The spool consists of segments: readings are appended to the active segment, which is synced to disk once per
+    append, and segments are sealed before they are replayed into the database. A sealed segment is only removed once
+    all of its readings are stored, and as storing readings is idempotent, a replay can safely be interrupted.
+    """
+    _directory: str
+    _active: Optional[BinaryIO]
+    _active_path: Optional[str]
+    _lock: threading.Lock
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        self._active = None
+        self._active_path = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # segments which were still active when a previous process stopped can be replayed as is
+        for path in glob.glob(os.path.join(directory, "*.active")):
+            os.replace(path, path[:-len(".active")] + ".spool")
+
+    @property
+    def pending(self) -> bool:
+        """ Get whether the spool holds any readings that still need to be replayed. """
+        return self._active is not None or bool(self._segments())
+
+    def _segments(self) -> List[str]:
+        """ Get the paths of the sealed segments, oldest first. """
+        return sorted(glob.glob(os.path.join(self._directory, "*.spool")))
+
+    def append(self, readings: List[Reading]):
+        """
+        Durably append readings to the spool.
+        :param readings: The readings to append.
+        """
+        data = b"".join(_RECORD.pack(reading.netatmo_id, reading.room_id, reading.start.int_timestamp,
+                                     reading.end.int_timestamp, reading.reading) for reading in readings)
+        with self._lock:
+            if self._active is None:
+                self._active_path = os.path.join(self._directory, f"readings-{time.time_ns()}.active")
+                self._active = open(self._active_path, "ab")  # pylint: disable=consider-using-with
+            self._active.write(data)
+            self._active.flush()
+            os.fsync(self._active.fileno())
+        debug("spooled %s readings", len(readings))
+
+    def seal(self):
+        """ Seal the active segment, if any, so that its readings can be replayed. """
+        with self._lock:
+            if self._active is not None:
+                self._active.close()
+                os.replace(self._active_path, self._active_path[:-len(".active")] + ".spool")
+                self._active = None
+                self._active_path = None
+
+    @staticmethod
+    def _read(path: str, batch_size: int) -> Iterator[List[Reading]]:
+        """ Read the readings of a segment in batches, ignoring a partially written record at its end. """
+        with open(path, "rb") as file:
+            while chunk := file.read(_RECORD.size * batch_size):
+                chunk = chunk[:len(chunk) - len(chunk) % _RECORD.size]
+                yield [Reading(netatmo_id, room_id, from_timestamp(start, tz="Europe/London"),
+                               from_timestamp(end, tz="Europe/London"), value)
+                       for netatmo_id, room_id, start, end, value in _RECORD.iter_unpack(chunk)]
+
+    def replay(self, store: Callable[[List[Reading]], None], batch_size: int = 10000) -> int:
+        """
+        Replay all spooled readings, removing each segment once all of its readings are stored.
+        :param store: The function which stores a batch of readings, raising an error when they cannot be stored.
+        :param batch_size: The maximum number of readings to store at once.
+        :return: The number of readings that were replayed.
+        """
+        self.seal()
+        replayed = 0
+        for path in self._segments():
+            for batch in self._read(path, batch_size):
+                store(batch)
+                replayed += len(batch)
+            os.remove(path)
+            debug("replayed spool segment %s", path)
+        return replayed
@@ -0,0 +1,131 @@
+# pylint: disable=line-too-long, missing-module-docstring
+
+import threading
+import time
+from dataclasses import dataclass
+from logging import debug
+from typing import Callable, Dict, Optional
+
+from chai_data_sources import NetatmoClient
+from pendulum import from_timestamp
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session, scoped_session
+
+from chai_persistence.db_definitions import NetatmoDevice, NetatmoToken, db_session
+
+
+@dataclass(frozen=True)
+class Token:
+    """ The OAuth tokens of a Netatmo relay. """
+    access_token: str
+    refresh_token: str
+    expires_at: float  # the UNIX timestamp at which the access token expires
+
+    def expires_within(self, seconds: float) -> bool:
+        """ Get whether the access token expires within the given number of seconds. """
+        return self.expires_at - time.time() < seconds
+
+
+# the Netatmo client does not document how its tokens are exposed, so all knowledge of its internals is kept in the
+#  two functions below; when a client does not expose its tokens, tokens are simply neither cached nor restored
+
+
+def token_of(client: NetatmoClient) -> Optional[Token]:
+    """
+    Get the current tokens of a client.
+    :param client: The client of a Netatmo relay.
+    :return: The tokens of the client, or None if the client does not expose them.
+    """
+    access_token = getattr(client, "access_token", None)
+    refresh_token = getattr(client, "refresh_token", None)
+    expires_at = getattr(client, "expires_at", None)
+    if not access_token or not refresh_token or expires_at is None:
+        return None
+    return Token(access_token, refresh_token, float(expires_at))
+
+
+def reuse_client(client_factory: Callable[..., NetatmoClient], token: Optional[Token], **kwargs) -> Optional[NetatmoClient]:
+    """
+    Create a client from a cached access token, without refreshing it, if the token is still valid and the client
+    supports this.
+    :param client_factory: The function which creates a client.
+    :param token: The stored tokens of the relay, if any.
+    :param kwargs: The arguments of the client, including its refresh token.
+    :return: The client of the relay, or None if a client can only be created by refreshing its access token.
+    """
+    if token is None or token.expires_within(0):
+        return None
+    try:
+        return client_factory(access_token=token.access_token, expires_at=token.expires_at, **kwargs)
+    except TypeError:
+        return None  # the client cannot reuse an access token
+
+
+class TokenCache:
+    """
+    Keep the tokens of the Netatmo relays in the database, so that a restart can reuse the access tokens rather than
+    refreshing all of them at once. Whenever a refresh token is rotated, it is also written back to the relay.
+    The tokens of a relay are read whenever its client is created, as another worker may have rotated them since.
+    Errors of the database are only logged, so that a client can always be created by refreshing its access token.
+    """
+    _st_session: scoped_session
+    _tokens: Dict[int, Token]  # the tokens last read or stored for each relay
+    _lock: threading.Lock
+
+    def __init__(self, st_session: scoped_session):
+        self._st_session = st_session
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def get(self, netatmo_id: int) -> Optional[Token]:
+        """
+        Get the current tokens of a relay from the database.
+        :param netatmo_id: The database id of the relay.
+        :return: The tokens of the relay, of which the access token may have expired (or be empty if none is cached),
+                 or None if the tokens cannot be read.
+        """
+        session: Session
+        try:
+            with db_session(self._st_session) as session:
+                row = session.execute(select(NetatmoDevice.refreshToken, NetatmoToken.accessToken, NetatmoToken.expiresAt)
+                                      .outerjoin(NetatmoToken).where(NetatmoDevice.id == netatmo_id)).one_or_none()
+        except Exception as err:  # pylint: disable=broad-except
+            debug(f"Encountered an error reading the tokens of relay {netatmo_id}: {err}\nRefreshing them instead.")
+            return None
+        if row is None:
+            return None
+        refresh_token, access_token, expires_at = row
+        token = Token(access_token or "", refresh_token, expires_at.timestamp() if expires_at is not None else 0.0)
+        with self._lock:
+            self._tokens[netatmo_id] = token
+        return token
+
+    def put(self, netatmo_id: int, token: Token):
+        """
+        Store the tokens of a relay, writing back its refresh token if it was rotated.
+        :param netatmo_id: The database id of the relay.
+        :param token: The current tokens of the relay.
+        """
+        with self._lock:
+            previous = self._tokens.get(netatmo_id)
+            if previous == token:
+                return
+        row = {"netatmoid": netatmo_id, "accesstoken": token.access_token, "expiresat": from_timestamp(token.expires_at)}
+        statement = insert(NetatmoToken.__table__).values(row)
+        session: Session
+        try:
+            with db_session(self._st_session) as session:
+                session.execute(statement.on_conflict_do_update(
+                    index_elements=["netatmoid"],
+                    set_={"accesstoken": statement.excluded.accesstoken, "expiresat": statement.excluded.expiresat}
+                ))
+                if previous is None or previous.refresh_token != token.refresh_token:
+                    session.execute(update(NetatmoDevice.__table__).where(NetatmoDevice.__table__.c.id == netatmo_id)
+                                    .values(refreshtoken=token.refresh_token))
+        except Exception as err:  # pylint: disable=broad-except
+            # the tokens are stored again with the next refresh, as they are still unknown to be stored
+            debug(f"Encountered an error storing the tokens of relay {netatmo_id}: {err}\nRetrying later.")
+            return
+        with self._lock:
+            self._tokens[netatmo_id] = token
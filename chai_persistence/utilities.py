@@ -1,7 +1,10 @@
 # pylint: disable=line-too-long, missing-module-docstring, too-few-public-methods, missing-class-docstring
 
+from dataclasses import dataclass
 from typing import Dict, Optional, TypeVar, Callable, Union
 
+from pendulum import DateTime, from_timestamp
+
 V = TypeVar("V")
 K = TypeVar("K")
 T = TypeVar("T")
@@ -26,3 +29,24 @@ def optional(source: Optional[Dict[K, V]], key: K, default: V = None,
         return element if mapping is None else mapping(element)
     except (KeyError, IndexError):
         return default if mapping is None or default is None else mapping(default)
+
+
+@dataclass(frozen=True)
+class Slot:
+    """ A single polling interval, identified by its start and end time. """
+    start: DateTime
+    end: DateTime
+
+
+def slot_at(timestamp: float, interval: int, tz: str = "Europe/London") -> Slot:
+    """
+    Get the slot that contains the given moment in time.
+    Slots are aligned to the epoch, which for intervals that divide an hour means they are aligned to the hour.
+    :param timestamp: The moment in time as a UNIX timestamp.
+    :param interval: The length of each slot in seconds.
+    :param tz: The timezone in which to express the start and end of the slot.
+    :return: The slot that contains the given moment.
+    """
+    start = int(timestamp // interval) * interval
+    return Slot(from_timestamp(start, tz=tz), from_timestamp(start + interval, tz=tz))
+
@@ -0,0 +1,366 @@
+# pylint: disable=line-too-long, missing-module-docstring
+# pylint: disable=loop-invariant-statement, loop-try-except-usage
+
+import threading
+import time
+from dataclasses import replace
+from logging import debug, error
+from queue import Queue, Empty
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
+
+from sqlalchemy import bindparam, func, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+from sqlalchemy.sql.dml import Insert
+from sqlalchemy.orm import Session, scoped_session
+
+from chai_persistence.db_definitions import NetatmoReading, NetatmoWideReading, db_session
+from chai_persistence.metrics import COMMIT_LATENCY, SLOT_TO_COMMIT, READINGS_WRITTEN, READINGS_SPOOLED, WRITE_FAILURES
+from chai_persistence.migrations import has_unique_natural_key, stores_wide_rows
+from chai_persistence.readings import Reading, WIDE_COLUMNS, to_wide_rows
+from chai_persistence.rollups import update_rollups
+from chai_persistence.spool import Spool
+
+# the columns of the unique index `ix_one_reading`, which identify a single reading
+NATURAL_KEY = ["netatmoid", "roomid", "start"]
+
+# extends the end of a stored reading, when compressing runs of unchanged values
+_EXTEND = update(NetatmoReading.__table__).where(
+    NetatmoReading.__table__.c.netatmoid == bindparam("b_netatmoid"),
+    NetatmoReading.__table__.c.roomid == bindparam("b_roomid"),
+    NetatmoReading.__table__.c.start == bindparam("b_start"),
+).values(end=bindparam("b_end"))
+
+# inserts a batch of readings of any size with the same statement text, passing each column as an array, so that the
+#  statement can be prepared on the server once for every connection; the readings must be unique within a batch
+_PREPARED_INSERT = """
+INSERT INTO netatmoreading (netatmoid, roomid, start, "end", reading)
+SELECT * FROM unnest(CAST(:netatmoids AS integer[]), CAST(:roomids AS integer[]), CAST(:starts AS timestamptz[]),
+                     CAST(:ends AS timestamptz[]), CAST(:readings AS double precision[]))
+ON CONFLICT (netatmoid, roomid, start) DO {}
+"""
+_ON_CONFLICT = {"nothing": "NOTHING", "update": 'UPDATE SET "end" = excluded."end", reading = excluded.reading'}
+
+# the columns of the unique index `ix_one_wide_reading`, which identify the readings of a relay during one slot
+WIDE_KEY = ["netatmoid", "start"]
+
+# PostgreSQL accepts at most 65535 bind parameters in one statement, so larger batches are inserted in several parts
+_MAX_PARAMETERS = 65535
+
+
+class ReadingWriter(threading.Thread):
+    """
+    Collect the readings of all homes and write them to the database in batches, rather than committing each home
+    separately. A batch is written once it holds `batch_size` readings, or `batch_delay` seconds after its first
+    reading arrived, whichever comes first. Each batch is written in one transaction, as a single
+    multi-row insert unless it exceeds the number of bind parameters a statement accepts.
+    Readings of which the relay, room, and slot are already stored are either ignored or overwrite the stored reading,
+    so that the same readings can safely be written more than once.
+    With `storage` set to "wide", the readings of a relay during one slot are written as a single row of the
+    `netatmowidereading` table instead, of which the values are only set if they were retrieved.
+    With `compress` enabled (and readings stored as a row per reading), a reading which is within `deadband` of the last
+    stored reading of its relay and room, and which directly follows it, extends the end of the stored reading instead
+    of being stored as a new row. The last stored reading of each relay and room is kept in memory, and a reading for a
+    slot which such a run already covers is ignored rather than stored as an overlapping row.
+    With `rollups` enabled, the hourly and daily rollups touched by a batch are updated in the same transaction.
+    When a spool is given, batches that cannot be written, or that arrive while the backlog exceeds `max_backlog`
+    readings, are appended to the spool instead. The spool is replayed as soon as the database accepts writes again.
+    When drained, the readings which could not be written before the deadline are spooled (or dropped without a spool).
+    With `prepared` enabled, the writer keeps a connection of its own rather than taking one from the pool for every
+    batch, and (for a row per reading with pg8000) inserts through a statement that is prepared on the server once.
+    """
+    _stop_event: threading.Event
+    _queue: "Queue[Reading]"
+    _st_session: scoped_session
+    _batch_size: int
+    _batch_delay: float
+    _on_conflict: str
+    _storage: str
+    _rollups: bool
+    _compress: bool
+    _deadband: float
+    _runs: Dict[Tuple[int, int], Reading]  # the last stored reading of each relay and room, when compressing
+    _spool: Optional[Spool]
+    _max_backlog: int
+    _replay_after: float
+    _deadline: float
+    _prepared: bool
+    _connection: Optional[Connection]
+    _statements: Dict[str, Any]  # the statements prepared on the dedicated connection, by `on_conflict`
+    _retry_delay: float = 60.0
+
+    def __init__(self, *, st_session: scoped_session, batch_size: int = 1000, batch_delay: float = 1.0,
+                 on_conflict: str = "nothing", storage: str = "long", rollups: bool = False, compress: bool = False,
+                 deadband: float = 0.0, spool: Optional[Spool] = None, max_backlog: int = 100000, prepared: bool = False):
+        super().__init__(name="reading writer")
+        self._stop_event = threading.Event()
+        self._queue = Queue()
+        self._st_session = st_session
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._on_conflict = on_conflict
+        self._storage = storage
+        self._rollups = rollups
+        self._compress = compress and storage == "long"
+        self._deadband = deadband
+        self._runs = {}
+        self._spool = spool
+        self._max_backlog = max_backlog
+        self._replay_after = 0.0
+        self._deadline = float("inf")
+        self._prepared = prepared
+        self._connection = None
+        self._statements = {}
+
+    @property
+    def stopped(self) -> bool:
+        """ Get whether this writer has been stopped. """
+        return self._stop_event.is_set()
+
+    @property
+    def backlog(self) -> int:
+        """ Get the number of readings waiting to be written. """
+        return self._queue.qsize()
+
+    def configure(self, *, batch_size: int, batch_delay: float, on_conflict: str):
+        """
+        Change how readings are written while this writer is running, e.g. when the configuration is reloaded.
+        :param batch_size: The maximum number of readings written in one transaction.
+        :param batch_delay: The maximum number of seconds a reading waits before being written.
+        :param on_conflict: Either "nothing" to ignore or "update" to overwrite readings that are already stored.
+        """
+        self._batch_size = batch_size
+        self._batch_delay = batch_delay
+        self._on_conflict = on_conflict
+
+    def check(self) -> bool:
+        """
+        Check that the database enforces the natural key of the readings, without which inserts cannot ignore or update
+        readings that are already stored. Only PostgreSQL is checked, as SQLite only stands in for it when benchmarking.
+        :return: True if the readings can be written, False if the migrations have to be applied first.
+        """
+        with self._st_session.get_bind().connect() as connection:
+            if connection.dialect.name != "postgresql" or self._storage == "wide" or stores_wide_rows(connection):
+                return True  # wide rows are unique by definition
+            return has_unique_natural_key(connection)
+
+    def put(self, readings: Iterable[Reading]):
+        """
+        Queue readings to be written to the database. This call never blocks and is safe to use from any thread.
+        :param readings: The readings to write.
+        """
+        for reading in readings:
+            self._queue.put_nowait(reading)
+
+    def _next_batch(self) -> List[Reading]:
+        """ Wait for the next batch of readings, which is empty if no readings arrived in time. """
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=self._batch_delay))
+        except Empty:
+            return batch
+
+        deadline = time.monotonic() + self._batch_delay
+        while len(batch) < self._batch_size:
+            # when stopping, only take what is already queued rather than waiting for the batch to fill up
+            remaining = 0 if self.stopped else deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except Empty:
+                break
+        return batch
+
+    def _statement(self, batch: List[Reading], dialect: str = "postgresql") -> Insert:
+        """ Get the statement that inserts a batch of readings, either ignoring or updating already stored readings. """
+        # SQLite only stands in for PostgreSQL when benchmarking, and supports the same upsert
+        insert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+        if self._storage == "wide":
+            return self._wide_statement(batch, insert)
+        # a single statement cannot affect the same row twice, so only the last reading for each slot is kept
+        rows = [reading.as_row() for reading in {reading.key: reading for reading in batch}.values()]
+        statement = insert(NetatmoReading.__table__).values(rows)
+        if self._on_conflict == "update":
+            return statement.on_conflict_do_update(
+                index_elements=NATURAL_KEY, set_={"end": statement.excluded.end, "reading": statement.excluded.reading}
+            )
+        return statement.on_conflict_do_nothing(index_elements=NATURAL_KEY)
+
+    def _wide_statement(self, batch: List[Reading], insert) -> Insert:
+        """ Get the statement that inserts a batch of readings as wide rows, either ignoring or updating stored values. """
+        table = NetatmoWideReading.__table__
+        statement = insert(table).values(to_wide_rows(batch))
+        # the values of a relay may be stored in parts (e.g. when replaying), so a row is always merged with the new
+        #  values, where either the stored values or the new values take precedence
+        first, second = (table.c, statement.excluded) if self._on_conflict == "nothing" else (statement.excluded, table.c)
+        return statement.on_conflict_do_update(
+            index_elements=WIDE_KEY,
+            set_={column: func.coalesce(first[column], second[column]) for column in ["end", *WIDE_COLUMNS.values()]}
+        )
+
+    def _compress_runs(self, batch: List[Reading]) -> Tuple[List[Reading], List[Reading], Dict[Tuple[int, int], Reading]]:
+        """
+        Split a batch of readings into the readings that start a new run, and the stored readings that are extended.
+        :param batch: The readings to split.
+        :return: The readings to insert, the stored readings with their new end, and the last stored reading of each
+                 relay and room once the batch is written.
+        """
+        runs = dict(self._runs)
+        inserted: Dict[Tuple, Reading] = {}
+        extended: Dict[Tuple, Reading] = {}
+        for reading in sorted(batch, key=lambda reading: reading.start):
+            series = (reading.netatmo_id, reading.room_id)
+            last = runs.get(series)
+            if last is not None and last.start <= reading.start < last.end:
+                continue  # the slot is already covered by a run, e.g. as the same reading is written again
+            if last is not None and reading.start == last.end and abs(reading.reading - last.reading) <= self._deadband:
+                runs[series] = replace(last, end=reading.end)
+                # a run that starts in this batch is inserted with its new end right away
+                (inserted if last.key in inserted else extended)[last.key] = runs[series]
+                continue
+            inserted[reading.key] = reading
+            if last is None or reading.start >= last.end:  # replayed readings are older and do not start a new run
+                runs[series] = reading
+        return list(inserted.values()), list(extended.values()), runs
+
+    def _dedicated(self) -> Connection:
+        """ Get the connection of this writer, connecting again if it was lost. """
+        if self._connection is None:
+            self._connection = self._st_session.get_bind().connect()
+            self._statements = {}
+        return self._connection
+
+    def _disconnect(self):
+        """ Close the connection of this writer, along with the statements prepared on it. """
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:  # pylint: disable=broad-except
+                pass  # the connection is most likely broken already
+            self._connection = None
+            self._statements = {}
+
+    def _insert_prepared(self, connection: Connection, rows: List[Reading]) -> bool:
+        """ Insert readings through a statement prepared on the dedicated connection, if its driver supports this. """
+        driver_connection = connection.connection.dbapi_connection
+        if self._storage != "long" or not hasattr(driver_connection, "prepare"):
+            return False
+        if self._on_conflict not in self._statements:
+            self._statements[self._on_conflict] = driver_connection.prepare(
+                _PREPARED_INSERT.format(_ON_CONFLICT[self._on_conflict]))
+        rows = list({reading.key: reading for reading in rows}.values())
+        self._statements[self._on_conflict].run(netatmoids=[reading.netatmo_id for reading in rows],
+                                                roomids=[reading.room_id for reading in rows],
+                                                starts=[reading.start for reading in rows],
+                                                ends=[reading.end for reading in rows],
+                                                readings=[reading.reading for reading in rows])
+        return True
+
+    def _execute(self, connection: Union[Connection, Session], batch: List[Reading], rows: List[Reading],
+                 extended: List[Reading], dialect: str):
+        """ Store a batch of readings, of which some may extend stored readings instead, within a transaction. """
+        if rows and not (isinstance(connection, Connection) and self._insert_prepared(connection, rows)):
+            if self._storage == "long":  # the last reading for each slot is kept, even across parts
+                rows = list({reading.key: reading for reading in rows}.values())
+            # each reading takes at most one row, of 5 columns when long, or of 3 columns and one per room when wide
+            size = _MAX_PARAMETERS // (3 + len(WIDE_COLUMNS) if self._storage == "wide" else 5)
+            for start in range(0, len(rows), size):
+                connection.execute(self._statement(rows[start:start + size], dialect))
+        if extended:
+            connection.execute(_EXTEND, [{"b_netatmoid": reading.netatmo_id, "b_roomid": reading.room_id,
+                                          "b_start": reading.start, "b_end": reading.end} for reading in extended])
+        if self._rollups:
+            update_rollups(connection, batch)
+
+    def _flush(self, batch: List[Reading]):
+        """ Write a batch of readings to the database in a single transaction. """
+        rows, extended, runs = self._compress_runs(batch) if self._compress else (batch, [], None)
+        session: Session
+        with COMMIT_LATENCY.time():
+            if self._prepared:
+                connection = self._dedicated()
+                try:
+                    with connection.begin():
+                        self._execute(connection, batch, rows, extended, connection.dialect.name)
+                except Exception:
+                    self._disconnect()  # the prepared statements are reset along with the connection
+                    raise
+            else:
+                with db_session(self._st_session) as session:
+                    self._execute(session, batch, rows, extended, session.get_bind().dialect.name)
+        if runs is not None:
+            self._runs = runs  # the runs are only known to be stored once the transaction is committed
+        committed = time.time()
+        for reading in batch:
+            SLOT_TO_COMMIT.observe(committed - (reading.start.timestamp() + reading.end.timestamp()) / 2)
+        READINGS_WRITTEN.inc(len(batch))
+        debug("wrote a batch of %s readings", len(batch))
+
+    def run(self):
+        """ Start writing batches in a blocking way. Call `start()` instead for a non-blocking writer. """
+        while not (self.stopped and self._queue.empty()):
+            if batch := self._next_batch():
+                self._write(batch)
+            if not self.stopped and self._spool is not None and time.monotonic() >= self._replay_after and self._spool.pending:
+                self._replay()
+        if self._spool is not None:
+            self._spool.seal()
+        self._disconnect()
+
+    def _write(self, batch: List[Reading]):
+        """ Write a batch of readings to the database, or to the spool if the database is unavailable or falling behind. """
+        if time.monotonic() > self._deadline:
+            # the writer is being drained and ran out of time, so the remaining readings are not written
+            if self._spool is None:
+                print(f"  dropped {len(batch)} readings which could not be written in time")
+                return
+            self._spool.append(batch)
+            READINGS_SPOOLED.inc(len(batch))
+            return
+        if self._spool is not None and self._queue.qsize() > self._max_backlog:
+            # the database cannot keep up, so the backlog is moved to the spool rather than allowed to grow
+            self._spool.append(batch)
+            READINGS_SPOOLED.inc(len(batch))
+            self._replay_after = time.monotonic() + self._retry_delay
+            return
+        try:
+            self._flush(batch)
+        except Exception as err:  # pylint: disable=broad-except
+            WRITE_FAILURES.inc()
+            if self._spool is None:
+                error(f"Encountered an error writing {len(batch)} readings: {err}\nThe readings are lost.")
+                return
+            debug(f"Encountered an error writing {len(batch)} readings: {err}\nThe readings are spooled.")
+            self._spool.append(batch)
+            READINGS_SPOOLED.inc(len(batch))
+            self._replay_after = time.monotonic() + self._retry_delay
+
+    def replay(self) -> int:
+        """
+        Replay the spooled readings into the database in large batches.
+        :return: The number of readings that were replayed.
+        """
+        return self._spool.replay(self._flush) if self._spool is not None else 0
+
+    def _replay(self):
+        """ Replay the spooled readings into the database, retrying later if the database is still unavailable. """
+        try:
+            print(f"  replayed {self.replay()} spooled readings")
+        except Exception as err:  # pylint: disable=broad-except
+            debug(f"Encountered an error replaying the spooled readings: {err}\nRetrying later.")
+            self._replay_after = time.monotonic() + self._retry_delay
+
+    def stop(self):
+        """ Stop this writer once all readings that are already queued have been written. """
+        self._stop_event.set()
+
+    def drain(self, timeout: float) -> bool:
+        """
+        Stop this writer, and wait while the readings that are already queued are written for at most `timeout` seconds.
+        Readings that are still queued by then are spooled instead, so a shutdown never waits on a slow database.
+        :param timeout: The maximum number of seconds to spend writing the queued readings.
+        :return: True if this writer stopped in time, False if it is still busy with a write to the database.
+        """
+        self._deadline = time.monotonic() + timeout
+        self.stop()
+        self.join(timeout + self._batch_delay + 5)  # spooling what remains after the deadline takes little time
+        return not self.is_alive()
@@ -9,11 +9,11 @@ setup(
     author_email="kim.bauters@bristol.ac.uk",
     license="Protected",
     install_requires=["pendulum",  # handle datetime instances with ease
-                      "pause",  # convenient sleeping based on target times
                       "click",  # easy decorator style command line interface
                       "pg8000",  # pure Python PostgreSQL database adapter
                       "sqlalchemy",  # SQL database ORM solution
                       "tomli",  # TOML configuration file parser
                       # "chai_data_sources",
                       ],
+    extras_require={"numpy": ["numpy"]},  # read the readings as arrays through `chai_persistence.reader`
 )
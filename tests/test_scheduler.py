@@ -0,0 +1,34 @@
+# pylint: disable=missing-module-docstring, missing-function-docstring
+
+import time
+from collections import Counter
+
+from chai_persistence.scheduler import SlotScheduler
+
+
+def test_home_added_again_is_polled_once_per_slot():
+    scheduler = SlotScheduler(interval=1, window=0)
+    scheduler.start()
+    polls = Counter()
+    try:
+        scheduler.add("home", lambda slot: polls.update([slot.start.int_timestamp]))
+        scheduler.remove("home")
+        scheduler.add("home", lambda slot: polls.update([slot.start.int_timestamp]))
+        time.sleep(3.2)
+    finally:
+        scheduler.stop()
+    assert len(polls) >= 2
+    assert set(polls.values()) == {1}
+
+
+def test_removed_home_is_no_longer_polled():
+    scheduler = SlotScheduler(interval=1, window=0)
+    scheduler.start()
+    polls = []
+    try:
+        scheduler.add("home", polls.append)
+        scheduler.remove("home")
+        time.sleep(1.5)
+    finally:
+        scheduler.stop()
+    assert not polls